@@ -10,6 +10,10 @@ Changes:
 __version__ = '10.10'
 
 if __name__ == '__main__':
+    import multiprocessing
+    # Required by the capture processes in a frozen Windows executable
+    multiprocessing.freeze_support()
+
     from model import *
     app = QtGui.QApplication(sys.argv)
     core = WinduCore()
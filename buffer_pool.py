@@ -0,0 +1,100 @@
+import numpy as np
+import threading, collections
+
+
+
+class BufferPool(object):
+    '''
+    Recycles frame-sized numpy arrays, keyed by shape and dtype, across all threads.
+
+    Every array created by the pool, or adopted from OpenCV, is counted,
+        so it can be verified that steady-state operation allocates no new frame-sized arrays.
+
+    The free arrays are bounded by max_free_bytes. Beyond it, the arrays of the shapes requested least recently
+        are dropped, e.g. the ones of a previous zoom level or display size.
+    '''
+
+    def __init__(self, max_free_bytes):
+        super(BufferPool, self).__init__()
+
+        # key: (shape, dtype), value: a list of arrays ready to be reused
+        # Ordered by the last request or release, the oldest first
+        self.free = collections.OrderedDict()
+        self.free_bytes = 0
+        self.max_free_bytes = max_free_bytes
+
+        self.lock = threading.Lock()
+        self.allocations = 0
+
+    def get(self, shape, dtype=np.uint8):
+        '''
+        Returns:
+            a numpy array of the shape and dtype, with undefined content
+        '''
+        key = (tuple(shape), np.dtype(dtype).str)
+
+        with self.lock:
+            arrays = self.free.pop(key, None)
+            if arrays:
+                array = arrays.pop()
+                self.free_bytes -= array.nbytes
+                # Most recently requested
+                if arrays:
+                    self.free[key] = arrays
+                return array
+            self.allocations += 1
+
+        return np.empty(shape, dtype)
+
+    def release(self, array):
+        '''
+        Return an array to the pool. The caller must not use it afterwards.
+        '''
+        if array is None:
+            return
+
+        key = (array.shape, array.dtype.str)
+
+        with self.lock:
+            arrays = self.free.pop(key, [])
+            arrays.append(array)
+            self.free[key] = arrays
+            self.free_bytes += array.nbytes
+
+            # Drop the arrays of the least recently used shapes
+            while self.free_bytes > self.max_free_bytes:
+                key, arrays = next(self.free.iteritems())
+                self.free_bytes -= arrays.pop().nbytes
+                if not arrays:
+                    del self.free[key]
+
+    def clear(self):
+        '''
+        Drop all free arrays, e.g. when the shapes in use have changed.
+        Arrays in use are not affected, and are pooled again when released.
+        '''
+        with self.lock:
+            self.free.clear()
+            self.free_bytes = 0
+
+    def adopt(self, array, previous):
+        '''
+        Count the array as an allocation if OpenCV allocated it instead of writing into the previous one,
+            e.g. ret, img = cap.read(image=previous)
+
+        Returns:
+            the array
+        '''
+        if not array is previous:
+            with self.lock:
+                self.allocations += 1
+
+        return array
+
+    def get_allocations(self):
+        return self.allocations
+
+
+
+# The pool shared by capture, processing, alignment, tuning and writing
+buffer_pool = BufferPool(max_free_bytes = 256 * 1024 * 1024)
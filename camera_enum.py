@@ -0,0 +1,149 @@
+import numpy as np
+import cv2, time, sys, threading, os, json
+
+
+
+class CameraEnumerator(object):
+    '''
+    Lists the video devices available to cv2.VideoCapture(), each with a stable device identity.
+
+    On Linux the devices are listed from /sys/class/video4linux without touching the hardware,
+        and the identity is derived from the USB serial number or the physical USB port,
+        so it survives reboots and re-enumeration of the /dev/videoN numbers.
+    On other platforms the candidate ids 0..max_cam_id-1 are listed, and the identity is the id itself.
+    '''
+
+    def __init__(self):
+        super(CameraEnumerator, self).__init__()
+
+        self.__init__parameters()
+
+    def __init__parameters(self):
+
+        with open('parameters/capture.json', 'r') as fh:
+            parms = json.loads(fh.read())
+
+        self.max_cam_id = parms['max_cam_id']
+        self.probe_timeout = parms['probe_timeout']
+
+        self.sysfs_root = '/sys/class/video4linux'
+
+    def list_devices(self):
+        '''
+        Returns:
+            a list of dictionaries, sorted by id
+                {
+                'id': int, the camera id for cv2.VideoCapture(),
+                'device': str, the stable identity of the device,
+                'name': str, the human-readable name of the device
+                }
+        '''
+        if os.path.isdir(self.sysfs_root):
+            return self.__list_sysfs()
+
+        devices = []
+        for id in range(self.max_cam_id):
+            devices.append({'id': id, 'device': 'id:{}'.format(id), 'name': 'Camera {}'.format(id)})
+        return devices
+
+    def __list_sysfs(self):
+
+        devices = []
+        for node in os.listdir(self.sysfs_root):
+            if not node.startswith('video'):
+                continue
+
+            path = os.path.join(self.sysfs_root, node)
+
+            # Each camera may expose more than one node, e.g. a metadata node.
+            # Only the node with index 0 delivers images.
+            if self.__read_attr(path, 'index', '0') != '0':
+                continue
+
+            # The USB interface directory, e.g. .../usb1/1-2/1-2:1.0
+            interface = os.path.realpath(os.path.join(path, 'device'))
+            usb_device = os.path.dirname(interface)
+
+            serial = self.__read_attr(usb_device, 'serial', '')
+            if serial:
+                vendor = self.__read_attr(usb_device, 'idVendor', '')
+                product = self.__read_attr(usb_device, 'idProduct', '')
+                device = 'usb:{}:{}:{}'.format(vendor, product, serial)
+            else:
+                # Without a serial number, identify the camera by the physical port it is plugged into
+                device = 'port:{}'.format(os.path.basename(interface))
+
+            devices.append({'id'    : int(node[len('video'):]),
+                            'device': device,
+                            'name'  : self.__read_attr(path, 'name', node)})
+
+        return sorted(devices, key=lambda d: d['id'])
+
+    def __read_attr(self, path, name, default):
+        try:
+            with open(os.path.join(path, name), 'r') as fh:
+                return fh.read().strip()
+        except IOError:
+            return default
+
+    def probe(self, devices):
+        '''
+        Open all devices in parallel and grab one frame from each.
+        Devices not delivering a frame within self.probe_timeout are left out.
+
+        Args:
+            devices: a list of dictionaries returned by self.list_devices()
+
+        Returns:
+            a list of the available devices, each dictionary with an additional key 'img'
+        '''
+        images = {}
+
+        def grab(id):
+            cap = cv2.VideoCapture(id)
+            if cap.isOpened():
+                ret, img = cap.read()
+                if ret:
+                    images[id] = img
+            cap.release()
+
+        threads = []
+        for d in devices:
+            t = threading.Thread(target=grab, args=(d['id'], ))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        t0 = time.time()
+        for t in threads:
+            t.join(max(self.probe_timeout - (time.time() - t0), 0))
+
+        available = []
+        for d in devices:
+            if d['id'] in images:
+                d = dict(d)
+                d['img'] = images[d['id']]
+                available.append(d)
+            else:
+                print 'Camera id: {} not available'.format(d['id'])
+
+        return available
+
+    def find_id(self, device):
+        '''
+        Resolve a device identity to the camera id currently assigned by the OS.
+
+        Args:
+            device: str, the device identity
+
+        Returns:
+            int, the camera id, or None if the device is not present
+        '''
+        if device.startswith('id:'):
+            return int(device[len('id:'):])
+
+        for d in self.list_devices():
+            if d['device'] == device:
+                return d['id']
+
+        return None
@@ -0,0 +1,98 @@
+import numpy as np
+import os, json
+
+
+
+class ResponseTable(object):
+    '''
+    The mean image brightness of a camera, measured over a grid of gain and exposure values
+        by the CamCalibThread.
+
+    Saved as parameters/<which_cam>_response.json, alongside the camera parameters.
+    Settings which equalize two cameras are computed by looking up both tables,
+        instead of iterating with feedback from the images.
+    '''
+
+    def __init__(self, which_cam, gains, exposures, means):
+        '''
+        Args:
+            which_cam: global constant, one of CAM_R, CAM_L, CAM_E
+            gains: list of int, the gain values in ascending order
+            exposures: list of int, the exposure values
+            means: list of lists, the mean brightness for each exposure (rows) and gain (columns)
+        '''
+        super(ResponseTable, self).__init__()
+
+        self.which_cam = which_cam
+        self.gains = list(gains)
+        self.exposures = list(exposures)
+
+        self.means = {}
+        for exposure, row in zip(self.exposures, means):
+            self.means[exposure] = np.array(row, np.float)
+
+    @classmethod
+    def get_filepath(cls, which_cam):
+        return 'parameters/' + which_cam + '_response.json'
+
+    @classmethod
+    def load(cls, which_cam):
+        '''
+        Returns:
+            the ResponseTable of the camera, or None if the camera has not been calibrated
+        '''
+        filepath = cls.get_filepath(which_cam)
+        if not os.path.exists(filepath):
+            return None
+
+        with open(filepath, 'r') as fh:
+            data = json.loads(fh.read())
+
+        return cls(which_cam, data['gains'], data['exposures'], data['means'])
+
+    def save(self):
+        data = {'gains': self.gains,
+                'exposures': self.exposures,
+                'means': [self.means[e].tolist() for e in self.exposures]}
+
+        with open(self.get_filepath(self.which_cam), 'w') as fh:
+            json.dump(data, fh)
+
+    def get_brightness(self, gain, exposure):
+        '''
+        Returns:
+            float, the brightness interpolated at the gain, or None if the exposure was not calibrated
+        '''
+        if not exposure in self.means:
+            return None
+
+        return float(np.interp(gain, self.gains, self.means[exposure]))
+
+    def get_gain(self, brightness, exposure):
+        '''
+        Returns:
+            float, the gain giving the brightness, or None if the exposure was not calibrated
+        '''
+        if not exposure in self.means:
+            return None
+
+        # Make the response monotonic for the inverse lookup, e.g. flat once saturated
+        row = np.maximum.accumulate(self.means[exposure])
+
+        return float(np.interp(brightness, row, self.gains))
+
+    def match_gain(self, other, gain, exposure):
+        '''
+        Args:
+            other: the ResponseTable of the other camera
+            gain, exposure: the settings of the other camera
+
+        Returns:
+            float, the gain of this camera giving the same brightness as the other camera at the same exposure,
+                or None if either table lacks the exposure
+        '''
+        brightness = other.get_brightness(gain, exposure)
+        if brightness is None:
+            return None
+
+        return self.get_gain(brightness, exposure)
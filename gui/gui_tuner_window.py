@@ -1,6 +1,7 @@
 import cv2, time, sys, threading, os, json
 from PyQt4 import QtCore, QtGui, QtOpenGL
 from constants import *
+from camera_response import ResponseTable
 
 
 
@@ -174,6 +175,18 @@ class CameraTunerWindow(TunerWindow):
             self.sync_box.toggled.connect(self.user_changed_sync)
             self.add_widget(self.sync_box)
 
+        # Focus the active cameras once
+        self.focus_btn = QtGui.QPushButton(parent=self)
+        self.focus_btn.setText('Auto Focus')
+        self.focus_btn.clicked.connect(self.user_clicked_focus)
+        self.add_widget(self.focus_btn)
+
+        # Record the response of the active cameras, for equalizing them by table lookup
+        self.calibrate_btn = QtGui.QPushButton(parent=self)
+        self.calibrate_btn.setText('Calibrate Response')
+        self.calibrate_btn.clicked.connect(self.user_clicked_calibrate)
+        self.add_widget(self.calibrate_btn)
+
     def __init__load_parameters(self):
         '''
         Load parameters from the .json file, and set the values of the QSliders
@@ -206,6 +219,12 @@ class CameraTunerWindow(TunerWindow):
         '''
         self.sync_box.setChecked(isChecked)
 
+    def user_clicked_focus(self):
+        self.controller.call_method( method_name = 'auto_focus' )
+
+    def user_clicked_calibrate(self):
+        self.controller.call_method( method_name = 'calibrate_cameras' )
+
     def user_changed_value(self, name, value):
         '''
         Called by the child widget method slider_released().
@@ -265,6 +284,36 @@ class CameraTunerWindowSet(object):
         self.windows[CAM_E] = CameraTunerWindow(controller, CAM_E, paired=False, parent=self)
         self.isSync = False
 
+        self.load_response_tables()
+
+    def load_response_tables(self):
+        '''
+        (Re)load the response tables of the cameras, e.g. after calibration. None if a camera is not calibrated.
+        '''
+        self.tables = {}
+        for which_cam in [CAM_R, CAM_L, CAM_E]:
+            self.tables[which_cam] = ResponseTable.load(which_cam)
+
+    def map_value(self, src_cam, dst_cam, name, value):
+        '''
+        Map a synchronized value from one camera to the other.
+        The gain is mapped by the response tables to give equal brightness, if both cameras are calibrated.
+        Other values are copied as they are.
+        '''
+        table_src = self.tables[src_cam]
+        table_dst = self.tables[dst_cam]
+
+        if name != 'gain' or table_src is None or table_dst is None:
+            return value
+
+        exposure = self.windows[src_cam].widgets['exposure'].value
+
+        gain = table_dst.match_gain(table_src, value, exposure)
+        if gain is None:
+            return value
+
+        return int(round(gain))
+
     def show(self):
         for i, win in enumerate(self.windows.values()):
             win.move(200+200*i, 200)
@@ -291,10 +340,12 @@ class CameraTunerWindowSet(object):
 
     def user_changed_value(self, which_cam, name, value):
         if which_cam == CAM_L and self.isSync:
+            value = self.map_value(CAM_L, CAM_R, name, value)
             self.windows[CAM_R].set_parameter(name, value)
             self.windows[CAM_R].apply_parameter(name, value)
 
         elif which_cam == CAM_R and self.isSync:
+            value = self.map_value(CAM_R, CAM_L, name, value)
             self.windows[CAM_L].set_parameter(name, value)
             self.windows[CAM_L].apply_parameter(name, value)
 
@@ -7,6 +7,7 @@ from controller import *
 from threads import *
 from constants import *
 from single_camera import *
+from shared_camera import *
 from stereo import Stereo as stereo
 
 
@@ -33,9 +34,20 @@ class WinduCore(object):
 
         self.view_mode = MICRO
 
+        self.cam_calib_thread = None
+
+        self.__init__parameters()
+
         # Start the video thread, also concurrent threads
         self.start_video_thread()
 
+    def __init__parameters(self):
+        """
+        Load capture parameters from the parameters/capture.json file.
+        """
+        with open('parameters/capture.json', 'r') as fh:
+            self.capture_parms = json.loads(fh.read())
+
     def __init__signals(self, connect=True):
         """
         Call the mediator to connect (or disconnect) signals to the gui.
@@ -60,6 +72,7 @@ class WinduCore(object):
             3 capture threads
             1 process thread
             1 camera tuning thread
+            1 auto focus thread
             1 align thread
             1 writer thread
 
@@ -77,6 +90,9 @@ class WinduCore(object):
         # 1 camera tuning thread
         self.__init_auto_cam_thread()
 
+        # 1 auto focus thread
+        self.__init_auto_focus_thread()
+
         # 1 align thread
         self.__init_align_thread()
 
@@ -88,9 +104,11 @@ class WinduCore(object):
         Stop the following in order:
             1 writer thread
             1 align thread
+            1 auto focus thread
             1 camera tuning thread
             1 process thread
             3 capture threads
+            1 decode pool (if any)
             3 camera objects
 
         The order of stopping is the reverse of start_video_thread()...
@@ -98,20 +116,41 @@ class WinduCore(object):
         """
         self.writer_thread.stop()
         self.align_thread.stop()
+        self.auto_focus_thread.stop()
         self.cam_tune_thread.stop()
         self.proc_thread.stop()
 
         for thread in self.cap_threads.values():
             thread.stop()
 
+        if not self.decode_pool is None:
+            self.decode_pool.close()
+
         for cam in self.cams.values():
             cam.close()
 
     def __init_cams(self):
-        """Instantiate 3 camera objects"""
+        """
+        Instantiate 3 camera objects, either operating the device in this process (SingleCamera)
+            or in a separate capture process (SharedMemoryCamera).
+
+        The cameras open their devices concurrently in the background.
+        Wait for each device up to its own timeout, then move on with whichever cameras are ready.
+        Late cameras attach themselves when they come up, in the meantime they deliver the blank image.
+        """
+        # With process isolation, each camera is captured in its own process
+        if self.capture_parms['process_isolation']:
+            Camera = SharedMemoryCamera
+        else:
+            Camera = SingleCamera
+
         self.cams = {}
         for key in [CAM_R, CAM_L, CAM_E]:
-            self.cams[key] = SingleCamera(which_cam = key)
+            self.cams[key] = Camera(which_cam = key)
+
+        for key in [CAM_R, CAM_L, CAM_E]:
+            if not self.cams[key].wait_until_opened():
+                print 'Camera {} not ready, continue without it until it comes up'.format(key)
 
     def __init_cap_threads(self, mode):
         """
@@ -123,10 +162,18 @@ class WinduCore(object):
         Args:
             mode: glocal constant, MICRO or AMBIENT
         """
+        # Optional pool decoding raw MJPEG frames for all capture threads
+        n_workers = self.capture_parms['decode_workers']
+        if n_workers > 0:
+            self.decode_pool = WorkerPool(n_workers)
+        else:
+            self.decode_pool = None
+
         self.cap_threads = {}
         for key in [CAM_R, CAM_L, CAM_E]:
             self.cap_threads[key] = CaptureThread(camera = self.cams[key],
-                                                  mediator = self.mediator)
+                                                  mediator = self.mediator,
+                                               decode_pool = self.decode_pool)
             self.cap_threads[key].start()
 
         if mode == MICRO:
@@ -164,6 +211,15 @@ class WinduCore(object):
                                                  mediator = self.mediator)
         self.cam_tune_thread.start()
 
+    def __init_auto_focus_thread(self):
+        """
+        Instantiate 1 auto focus thread. Do NOT call resume() to make it active.
+        """
+        self.auto_focus_thread = AutoFocusThread(cap_thread_R = self.active_cap_thread_R,
+                                                 cap_thread_L = self.active_cap_thread_L,
+                                                     mediator = self.mediator)
+        self.auto_focus_thread.start()
+
     def __init_align_thread(self):
         """
         Instantiate 1 image alignment thread. Do NOT call resume() to make it active.
@@ -172,6 +228,9 @@ class WinduCore(object):
                                               mediator = self.mediator)
         self.align_thread.start()
 
+        # Whether to resume the align thread when back from the AMBIENT mode
+        self.align_was_running = False
+
     def __init_writer_thread(self):
         """
         Instantiate 1 video writer thread. Do NOT call resume() to make it active.
@@ -193,6 +252,11 @@ class WinduCore(object):
         if mode == self.view_mode:
             return
 
+        # Alignment is meaningless with a single camera, so suspend it before going mono
+        if mode == AMBIENT:
+            self.align_was_running = not self.align_thread.isPaused
+            self.align_thread.pause()
+
         # Configure the active capturing threads
         if mode == MICRO:
             self.cap_threads[CAM_R].resume()
@@ -215,6 +279,15 @@ class WinduCore(object):
         self.cam_tune_thread.set_cap_threads(thread_R = self.active_cap_thread_R,
                                              thread_L = self.active_cap_thread_L)
 
+        # Update active capturing threads to the auto focus thread, stopping any focusing in progress
+        self.auto_focus_thread.pause()
+        self.auto_focus_thread.set_cap_threads(thread_R = self.active_cap_thread_R,
+                                               thread_L = self.active_cap_thread_L)
+
+        # Bring back the alignment if it was running before the AMBIENT mode
+        if mode == MICRO and self.align_was_running:
+            self.align_thread.resume()
+
         self.view_mode = mode
 
     def close(self):
@@ -239,6 +312,19 @@ class WinduCore(object):
         """
         self.writer_thread.toggle()
 
+    def toggle_native_recording(self):
+        """
+        Switch the recording mode between the display image and the native camera images.
+        Only when not recording.
+        """
+        if self.writer_thread.get_record_mode() == 'native':
+            mode = 'display'
+        else:
+            mode = 'native'
+
+        if self.writer_thread.set_record_mode(mode):
+            print 'Recording mode: {}'.format(mode)
+
     def toggle_auto_offset(self):
         """
         Toggle the status of the image alignment thread.
@@ -267,6 +353,42 @@ class WinduCore(object):
         """
         self.cam_tune_thread.toggle()
 
+    def auto_focus(self):
+        """
+        Focus the active cameras once. The auto focus thread pauses itself when done.
+        """
+        self.auto_focus_thread.resume()
+
+    def calibrate_cameras(self):
+        """
+        Sweep gain and exposure of the active cameras to record their response tables.
+        The camera tuning thread is paused meanwhile, and resumed by self.end_calibration() if it was running.
+        """
+        # Only one calibration at a time
+        if not self.cam_calib_thread is None and self.cam_calib_thread.is_alive():
+            return
+
+        self.cam_tune_was_running = not self.cam_tune_thread.isPaused
+        self.cam_tune_thread.pause()
+
+        cap_threads = []
+        for thread in [self.active_cap_thread_R, self.active_cap_thread_L]:
+            if not thread in cap_threads:
+                cap_threads.append(thread)
+
+        self.cam_calib_thread = CamCalibThread(cap_threads = cap_threads,
+                                                  mediator = self.mediator)
+        self.cam_calib_thread.start()
+
+    def end_calibration(self):
+        """
+        Called by the gui object when the CamCalibThread is done.
+        """
+        self.cam_tune_thread.load_response_tables()
+
+        if self.cam_tune_was_running:
+            self.cam_tune_thread.resume()
+
     def zoom_in(self):
         """
         Call the proc_thread.zoom_in() method to zoom in (enlarge) the image.
@@ -318,7 +440,13 @@ class WinduCore(object):
         """
         Still a functionality under development. Non-developer users do not have access to it.
         """
-        self.proc_thread.computingDepth = not self.proc_thread.computingDepth
+        self.proc_thread.toggle_stage('depth')
+
+    def equalize_cameras(self):
+        """
+        Toggle matching the colors and tones of the left image to the right image.
+        """
+        self.proc_thread.toggle_stage('color_match')
 
     def set_display_size(self, dim):
         """
@@ -340,16 +468,18 @@ class WinduCore(object):
 
     def save_cam_id(self, data):
         """
-        Save the camera id to the json file storing camera parameters.
+        Save the camera id and device identity to the json file storing camera parameters.
 
         Args:
             data: a dictionary
                 {
                 'id': int, the camera id read by the cv2.VideoCapture() class,
+                'device': str, the stable device identity from the CameraEnumerator,
                 'which_cam': global constant, one of CAM_R, CAM_L, CAM_E,
                 }
         """
         id = data['id']
+        device = data['device']
         which_cam = data['which_cam']
 
         filepath = 'parameters/' + which_cam + '.json'
@@ -357,6 +487,7 @@ class WinduCore(object):
             parm_vals = json.loads(fh.read())
 
         parm_vals['id'] = id
+        parm_vals['device'] = device
 
         with open(filepath, 'w') as fh:
             json.dump(parm_vals, fh)
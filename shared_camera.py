@@ -0,0 +1,203 @@
+import numpy as np
+import cv2, time, sys, threading, json, multiprocessing, Queue
+from constants import *
+from single_camera import SingleCamera
+from shared_frames import SharedFrameRing
+
+
+
+def apply_commands(cam, commands):
+    '''
+    Apply all camera commands waiting in the queue.
+    '''
+    while True:
+        try:
+            name, arg = commands.get_nowait()
+        except Queue.Empty:
+            return
+
+        if name == 'parameters':
+            cam.set_parameters(arg)
+        elif name == 'mode':
+            cam.set_mode(arg)
+
+
+
+def run_capture_process(which_cam, ring, commands, stopping, attached, reconnects):
+    '''
+    The main function of the capture process.
+
+    Operates the physical camera through a SingleCamera object and publishes frames into the shared ring.
+    Camera commands are applied between frames, as in the CaptureThread.
+    '''
+    cam = SingleCamera(which_cam)
+
+    while not stopping.is_set():
+
+        apply_commands(cam, commands)
+
+        if cam.is_raw():
+            buf = cam.read_raw()
+            img = cam.get_blank() if buf is None else cam.decode(buf)
+        else:
+            img = cam.read()
+
+        ring.write(img)
+
+        attached.value = int(cam.is_attached())
+        reconnects.value = cam.get_reconnects()
+
+    apply_commands(cam, commands)
+
+    # Also saves the parameters
+    cam.close()
+
+
+
+class SharedMemoryCamera(object):
+    '''
+    Has the same interface as SingleCamera, but the physical camera is operated in a separate process,
+        so capturing does not compete for the GIL with the threads of this process.
+
+    Frames are published by the capture process into a SharedFrameRing,
+        and self.read() returns them as zero-copy views into the shared memory.
+
+    Parameter values are mirrored in a SingleCamera object without hardware,
+        which also validates values and selects sensor modes.
+    '''
+
+    def __init__(self, which_cam):
+        super(SharedMemoryCamera, self).__init__()
+
+        self.which_cam = which_cam
+
+        self.model = SingleCamera(which_cam, hardware=False)
+
+        with open('parameters/capture.json', 'r') as fh:
+            capture_parms = json.loads(fh.read())
+
+        self.open_timeout = capture_parms['open_timeout']
+
+        # Each slot holds the largest sensor mode
+        w, h = self.model.modes[-1]
+        self.ring = SharedFrameRing(n_slots = capture_parms['ring_slots'],
+                                  max_bytes = w * h * 3)
+
+        self.commands = multiprocessing.Queue()
+        self.stopping = multiprocessing.Event()
+        self.attached = multiprocessing.RawValue('i', 0)
+        self.reconnects = multiprocessing.RawValue('i', 0)
+
+        self.last_count = 0
+
+        self.t_open = time.time()
+        self.process = multiprocessing.Process(target = run_capture_process,
+                                               args = (which_cam      ,
+                                                       self.ring      ,
+                                                       self.commands  ,
+                                                       self.stopping  ,
+                                                       self.attached  ,
+                                                       self.reconnects))
+        self.process.daemon = True
+        self.process.start()
+
+    def wait_until_opened(self):
+        '''
+        Block until the device is attached in the capture process,
+            or self.open_timeout has elapsed since opening started.
+
+        Returns:
+            True if the device is attached, False otherwise.
+        '''
+        while not self.is_attached():
+            if time.time() - self.t_open > self.open_timeout:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def read(self):
+        '''
+        Wait for the next frame published by the capture process, up to 0.1 second.
+
+        Returns:
+            a numpy view of the latest frame in the shared memory, or the blank image if there is none yet
+        '''
+        t0 = time.time()
+        while True:
+            count, img = self.ring.read()
+            if count != self.last_count or time.time() - t0 > 0.1:
+                break
+            time.sleep(0.002)
+
+        self.last_count = count
+
+        if img is None:
+            return self.model.get_blank()
+
+        return img
+
+    def get_blank(self):
+        return self.model.get_blank()
+
+    def get_largest_size(self):
+        return self.model.get_largest_size()
+
+    def is_raw(self):
+        # Decoding is done in the capture process
+        return False
+
+    def set_parameters(self, parameters):
+        self.model.set_parameters(parameters)
+        self.commands.put(('parameters', dict(parameters)))
+
+    def get_parameters(self):
+        return self.model.get_parameters()
+
+    def check_one_parm(self, name, value):
+        return self.model.is_valid_parm(name, value) and self.is_attached()
+
+    def set_one_parm(self, name, value):
+
+        if not self.check_one_parm(name, value):
+            return False
+
+        self.set_parameters({name: value})
+
+        return True
+
+    def get_one_parm(self, name):
+        return self.model.get_one_parm(name)
+
+    def select_mode(self, width, height):
+        return self.model.select_mode(width, height)
+
+    def set_mode(self, mode):
+        self.model.set_mode(mode)
+        self.commands.put(('mode', mode))
+
+    def get_which_cam(self):
+        return self.which_cam
+
+    def get_reconnects(self):
+        return self.reconnects.value
+
+    def is_attached(self):
+        return self.attached.value == 1
+
+    def close(self):
+        '''
+        Stop the capture process, which releases the device and saves the parameters.
+        Then drop the shared memory, which is freed when no frame views are referenced anymore.
+        '''
+        self.stopping.set()
+
+        self.process.join(3)
+        if self.process.is_alive():
+            print 'Capture process {} not responding, terminated'.format(self.which_cam)
+            self.process.terminate()
+            self.process.join()
+            # The terminated process could not save the parameters
+            self.model.save_parameters()
+
+        self.commands.close()
+        self.ring = None
@@ -0,0 +1,230 @@
+import numpy as np
+import time, multiprocessing
+
+
+
+class SharedFrameRing(object):
+    '''
+    A ring of frame slots in shared memory, written by one process and read by another without copying.
+
+    The writer fills the slot after the latest one, then publishes it by incrementing the frame counter.
+    A reader always gets the latest frame as a numpy view into the shared memory.
+    The slot being read is overwritten again only after (n_slots - 1) more frames,
+        so readers must finish with a frame well within that time.
+
+    The object can be passed to a multiprocessing.Process as an argument.
+    '''
+
+    def __init__(self, n_slots, max_bytes):
+        super(SharedFrameRing, self).__init__()
+
+        self.n_slots = n_slots
+        self.max_bytes = max_bytes
+
+        self.buffer = multiprocessing.RawArray('B', n_slots * max_bytes)
+        self.shapes = multiprocessing.RawArray('i', n_slots * 3) # (rows, cols, channels) of each slot
+        self.count = multiprocessing.RawValue('l', 0) # Number of frames written so far
+
+        self.__map()
+
+    def __map(self):
+        # Zero-copy numpy view of the shared memory
+        self.array = np.frombuffer(self.buffer, np.uint8)
+
+    def __getstate__(self):
+        # The numpy view is not picklable, it is mapped again in the other process
+        state = self.__dict__.copy()
+        del state['array']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__map()
+
+    def write(self, img):
+        '''
+        Copy the image into the next slot and publish it.
+
+        Returns:
+            False if the image does not fit into a slot, True otherwise.
+        '''
+        if img.nbytes > self.max_bytes:
+            return False
+
+        i = (self.count.value + 1) % self.n_slots
+
+        a = i * self.max_bytes
+        slot = self.array[a:(a + img.nbytes)].reshape(img.shape)
+        slot[...] = img # A single copy, even for non-contiguous images such as rotated views
+
+        self.shapes[(i*3):(i*3 + 3)] = list(img.shape)
+
+        # Publish only after the slot is completely written
+        self.count.value += 1
+
+        return True
+
+    def read(self):
+        '''
+        Returns:
+            a tuple (count, image)
+                count: int, the number of frames written so far, which identifies the frame
+                image: numpy view of the latest frame, or None if nothing has been written yet
+        '''
+        count = self.count.value
+        if count == 0:
+            return 0, None
+
+        i = count % self.n_slots
+        rows, cols, channels = self.shapes[(i*3):(i*3 + 3)]
+
+        a = i * self.max_bytes
+        img = self.array[a:(a + rows*cols*channels)].reshape((rows, cols, channels))
+
+        return count, img
+
+
+
+class SharedFrameQueue(object):
+    '''
+    A bounded FIFO of timestamped frames in shared memory, written by one process and read by another.
+
+    The writer copies each frame into a free slot, outside of the lock, and then publishes it.
+    The reader copies the oldest published frame out of its slot under the lock, and frees the slot.
+
+    When the queue is full, the writer either drops the oldest frame (policy 'drop_oldest'),
+        or waits until the reader frees a slot (policy 'block').
+
+    The object can be passed to a multiprocessing.Process as an argument.
+    '''
+
+    def __init__(self, n_slots, max_bytes, policy='drop_oldest'):
+        super(SharedFrameQueue, self).__init__()
+
+        self.n_slots = n_slots
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        self.buffer = multiprocessing.RawArray('B', n_slots * max_bytes)
+        self.shapes = multiprocessing.RawArray('i', n_slots * 3) # (rows, cols, channels) of each slot
+        self.times = multiprocessing.RawArray('d', n_slots) # Timestamp of each slot
+
+        self.head = multiprocessing.RawValue('l', 0) # Number of frames read or dropped so far
+        self.tail = multiprocessing.RawValue('l', 0) # Number of frames published so far
+        self.dropped = multiprocessing.RawValue('l', 0)
+        self.closed = multiprocessing.RawValue('i', 0)
+
+        self.lock = multiprocessing.Lock()
+        self.not_empty = multiprocessing.Condition(self.lock)
+        self.not_full = multiprocessing.Condition(self.lock)
+
+        self.__map()
+
+    def __map(self):
+        # Zero-copy numpy view of the shared memory
+        self.array = np.frombuffer(self.buffer, np.uint8)
+
+    def __getstate__(self):
+        # The numpy view is not picklable, it is mapped again in the other process
+        state = self.__dict__.copy()
+        del state['array']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__map()
+
+    def put(self, img, timestamp, timeout=None, is_alive=None):
+        '''
+        Called by the only writer.
+
+        Args:
+            timeout: float, the maximum seconds to wait for a free slot under the 'block' policy, or None
+            is_alive: a function returning False if the reader is gone, so waiting is pointless, or None
+
+        Returns:
+            False if the image does not fit into a slot, the queue is closed,
+                or no slot was freed in time, True otherwise.
+        '''
+        if img.nbytes > self.max_bytes:
+            return False
+
+        t0 = time.time()
+
+        with self.lock:
+            while self.tail.value - self.head.value >= self.n_slots:
+                if self.closed.value:
+                    return False
+
+                if self.policy == 'drop_oldest':
+                    self.head.value += 1
+                    self.dropped.value += 1
+                else:
+                    if not is_alive is None and not is_alive():
+                        return False
+                    if not timeout is None and time.time() - t0 > timeout:
+                        return False
+                    self.not_full.wait(0.1)
+
+            i = self.tail.value % self.n_slots
+
+        # The slot is not visible to the reader until published
+        a = i * self.max_bytes
+        slot = self.array[a:(a + img.nbytes)].reshape(img.shape)
+        slot[...] = img
+
+        self.shapes[(i*3):(i*3 + 3)] = list(img.shape)
+        self.times[i] = timestamp
+
+        with self.lock:
+            self.tail.value += 1
+            self.not_empty.notify()
+
+        return True
+
+    def get(self, timeout=0.1):
+        '''
+        Called by the only reader.
+
+        Returns:
+            a tuple (image, timestamp), the image being a copy of the oldest frame,
+                or (None, None) if no frame arrived within the timeout
+        '''
+        with self.lock:
+            if self.tail.value == self.head.value:
+                self.not_empty.wait(timeout)
+                if self.tail.value == self.head.value:
+                    return None, None
+
+            i = self.head.value % self.n_slots
+            rows, cols, channels = self.shapes[(i*3):(i*3 + 3)]
+
+            a = i * self.max_bytes
+            img = self.array[a:(a + rows*cols*channels)].reshape((rows, cols, channels)).copy()
+            timestamp = self.times[i]
+
+            self.head.value += 1
+            self.not_full.notify()
+
+        return img, timestamp
+
+    def close(self):
+        '''
+        No more frames will be put. The reader drains the remaining ones.
+        '''
+        with self.lock:
+            self.closed.value = 1
+            self.not_full.notify()
+            self.not_empty.notify()
+
+    def is_closed(self):
+        return self.closed.value == 1
+
+    def is_empty(self):
+        return self.tail.value == self.head.value
+
+    def get_free_slots(self):
+        return self.n_slots - (self.tail.value - self.head.value)
+
+    def get_dropped(self):
+        return self.dropped.value
@@ -1,6 +1,19 @@
 import numpy as np
-import cv2, time, sys, threading, json
+import cv2, time, sys, threading, json, collections
 from constants import *
+from camera_enum import CameraEnumerator
+from buffer_pool import buffer_pool
+
+
+
+def fourcc(code):
+    '''
+    Returns:
+        int, the four character code, e.g. 'MJPG', as used by OpenCV
+    '''
+    if hasattr(cv2, 'cv'):
+        return cv2.cv.CV_FOURCC(*code)
+    return cv2.VideoWriter_fourcc(*code)
 
 
 
@@ -9,9 +22,10 @@ class SingleCamera(object):
     A customized camera API that directly operates one physical camera through cv2.VideoCapture().
     '''
 
-    def __init__(self, which_cam):
+    def __init__(self, which_cam, hardware=True):
         '''
-        key: camera key among the constants (CAM_R, CAM_L or CAM_E)
+        which_cam: camera key among the constants (CAM_R, CAM_L or CAM_E)
+        hardware: if False, the device is never opened and the object only models the parameters
         '''
         super(SingleCamera, self).__init__()
 
@@ -19,18 +33,36 @@ class SingleCamera(object):
 
         self.__init__parameters()
 
-        self.cap = cv2.VideoCapture(self.parm_vals['id'])
+        self.__init__blank()
 
-        if not self.cap.isOpened():
-            self.cap = None
+        # The hardware is opened in a background thread,
+        #     so a missing or slow device does not block the caller.
+        # Until the device is ready, self.cap is None and self.read() returns the blank image.
+        # When the opener thread finishes, the camera is attached on the fly.
+        self.cap = None
+        self.hw_vals = {}
+        self.isClosing = False
+        self.lock = threading.Lock()
+        self.closed = threading.Event() # Interrupts the backoff of the opener thread
+        self.first_attempt_done = threading.Event()
 
-        self.__init__config()
+        # Buffers recycled through the buffer pool
+        self.hw_buf = None # The frame as delivered by the hardware
+        self.transposed = None
+        self.out_bufs = collections.deque() # The rotated frames returned by self.read()
 
-        self.img_blank = cv2.imread('images/blank_' + self.which_cam + '.tif')
+        self.n_failures = 0 # Consecutive failed reads
+        self.reconnects = 0
+
+        self.t_open = time.time()
+        if hardware:
+            self.__start_opener()
 
     def __init__parameters(self):
 
-        self.parm_ids = {'width'        : 3   ,
+        self.parm_ids = {'fourcc'       : 6   ,
+                         'convert_rgb'  : 16  ,
+                         'width'        : 3   ,
                          'height'       : 4   ,
                          'brightness'   : 10  ,
                          'contrast'     : 11  ,
@@ -56,40 +88,375 @@ class SingleCamera(object):
         elif self.which_cam == CAM_E:
             self.rotation = 0
 
-    def __init__config(self):
+        # Load capture parameters shared by all cameras
+        with open('parameters/capture.json', 'r') as fh:
+            capture_parms = json.loads(fh.read())
+
+        self.open_timeout = capture_parms['open_timeout']
+        self.max_read_failures = capture_parms['max_read_failures']
+        self.reconnect_delay_min = capture_parms['reconnect_delay_min']
+        self.reconnect_delay_max = capture_parms['reconnect_delay_max']
+
+        # The configured width and height is the largest sensor mode.
+        # Smaller modes of the same aspect ratio may be selected when full resolution is not needed.
+        W, H = self.parm_vals['width'], self.parm_vals['height']
+        self.modes = [(W, H)]
+        for w, h in capture_parms['sensor_modes']:
+            if w < W and h < H and abs(float(w) / h - float(W) / H) < 0.01:
+                self.modes.append((w, h))
+        self.modes.sort(key=lambda m: m[0] * m[1])
+
+        self.mode = (W, H)
+
+        # Above this number of pixels per frame, the compressed MJPEG format saves USB bandwidth.
+        # Below, the uncompressed YUYV format saves the decoding cost.
+        self.uncompressed_max_pixels = capture_parms['uncompressed_max_pixels']
+
+        self.n_out_bufs = capture_parms['ring_slots']
+
+        # In raw mode the compressed MJPEG buffers are read without decoding,
+        #     and decoded by the caller, e.g. on a worker pool.
+        self.isRaw = capture_parms['decode_workers'] > 0
+
+    def __init__blank(self):
+        '''
+        Load the blank image, which is resized along with the sensor mode.
+        '''
+        self.img_blank_0 = cv2.imread('images/blank_' + self.which_cam + '.tif')
+
+        self.__resize_blank()
+
+    def __resize_blank(self):
+        '''
+        Resize the blank image to the current sensor mode (after rotation),
+            so the blank image is interchangeable with a real frame in the downstream pipeline.
+        '''
+        w, h = self.mode
+        if self.rotation % 2 == 1:
+            w, h = h, w
+
+        self.img_blank = cv2.resize(self.img_blank_0, (w, h))
+
+    def __init__config(self, cap):
+
+        # The values last written to the hardware
+        self.hw_vals = {}
+
+        self.__write_changed(cap)
+
+    def __get_hw_vals(self):
+        '''
+        Returns:
+            a list of (name, value) of all hardware properties, in the order to be written.
+            The sensor mode (format and size) goes first, as it may reset other properties.
+        '''
+        w, h = self.mode
+        if w * h > self.uncompressed_max_pixels or self.isRaw:
+            code = 'MJPG'
+        else:
+            code = 'YUYV'
+
+        vals = [('fourcc', fourcc(code)),
+                ('width' , w           ),
+                ('height', h           )]
+
+        if self.isRaw:
+            vals.append(('convert_rgb', 0))
+
+        for name in self.parm_ids.keys():
+            if not name in ['fourcc', 'convert_rgb', 'width', 'height']:
+                vals.append((name, self.parm_vals[name]))
+
+        return vals
+
+    def __write_changed(self, cap):
+        '''
+        Write to the hardware only the parameter values that differ from the last written ones.
+        '''
+        for name, value in self.__get_hw_vals():
+            if self.hw_vals.get(name, None) != value:
+                cap.set(self.parm_ids[name], value)
+                self.hw_vals[name] = value
+
+    def __start_opener(self, stale_cap=None):
+
+        self.opener = threading.Thread(target=self.__open_loop, args=(stale_cap, ))
+        self.opener.daemon = True
+        self.opener.start()
+
+    def __open_loop(self, stale_cap):
+        '''
+        Runs in the opener thread.
+        Release the stale device (if any), then try to open the device with exponential backoff
+            until it is attached or the camera is closed.
+        '''
+        if not stale_cap is None:
+            # Releasing a disconnected device may block, which is why it is done here
+            stale_cap.release()
+
+        delay = self.reconnect_delay_min
+        while not self.isClosing:
+
+            isAttached = self.__open(verbose = delay == self.reconnect_delay_min)
+            self.first_attempt_done.set()
+
+            if isAttached:
+                return
+
+            self.closed.wait(delay)
+            delay = min(delay * 2, self.reconnect_delay_max)
+
+    def __open(self, verbose):
+        '''
+        Open and configure the hardware.
+
+        Returns:
+            True if the device is attached, False otherwise.
+        '''
+        # Resolve the stable device identity to the id currently assigned by the OS.
+        # Older parameter files without the identity keep using the stored id.
+        device = self.parm_vals.get('device', None)
+        if not device is None:
+            id = CameraEnumerator().find_id(device)
+            if id is None:
+                if verbose:
+                    print 'Camera {} (device: {}) not present'.format(self.which_cam, device)
+                return False
+            self.parm_vals['id'] = id
+
+        cap = cv2.VideoCapture(self.parm_vals['id'])
+
+        if not cap.isOpened():
+            if verbose:
+                print 'Camera {} (id: {}) not available'.format(self.which_cam, self.parm_vals['id'])
+            return False
+
+        # Restores the last parameters when reconnecting
+        self.__init__config(cap)
+
+        # Attach the configured device, unless the camera has been closed in the meantime
+        with self.lock:
+            if self.isClosing:
+                cap.release()
+                return False
+
+            self.n_failures = 0
+            self.cap = cap
+
+        return True
+
+    def __reconnect(self, cap):
+        '''
+        Detach the failing device and reopen it in the background.
+        Called from the reading thread, so it must not block.
+        '''
+        with self.lock:
+            if self.isClosing or not self.cap is cap:
+                return
+            self.cap = None
+            self.reconnects += 1
+
+        print 'Camera {} stopped delivering frames, reconnecting'.format(self.which_cam)
+
+        self.__start_opener(stale_cap=cap)
 
-        ids = self.parm_ids # dictionary
-        vals = self.parm_vals # dictionary
-        names = self.parm_ids.keys() # list
+    def wait_until_opened(self):
+        '''
+        Block until the first attempt of opening the device is done,
+            or self.open_timeout has elapsed since opening started.
+
+        Returns:
+            True if the device is attached, False otherwise.
+        '''
+        remaining = self.open_timeout - (time.time() - self.t_open)
+        self.first_attempt_done.wait(max(remaining, 0))
+        return not self.cap is None
+
+    def __read_hw(self, reuse):
+        '''
+        Args:
+            reuse: bool, if True the frame is read into the same buffer every time
+
+        Returns:
+            the frame as delivered by the hardware, or None if not available
+        '''
+        cap = self.cap
+        if not cap is None:
+            if reuse:
+                ret, img = cap.read(self.hw_buf)
+            else:
+                ret, img = cap.read()
 
-        if not self.cap is None:
-            for name in names:
-                self.cap.set( ids[name], vals[name] )
+            if ret:
+                if reuse:
+                    self.hw_buf = buffer_pool.adopt(img, self.hw_buf)
+                self.n_failures = 0
+                return img
+
+            # A sustained failure means the device is gone, e.g. a USB hiccup
+            self.n_failures += 1
+            if self.n_failures >= self.max_read_failures:
+                self.__reconnect(cap)
+
+        return None
 
     def read(self):
         '''Return the properly rotated image. If cv2_cam is None than return a blank image.'''
 
-        if not self.cap is None:
-            ret, img = self.cap.read()
-            if ret:
-                return np.rot90(img, self.rotation)
+        img = self.__read_hw(reuse=True)
+        if not img is None:
+            return self.__rotate(img)
 
         time.sleep(0.01)
         # Must insert a time delay to emulate camera harware delay
         # Otherwise the program will crash due to full-speed looping
         return self.img_blank
 
+    def __rotate(self, img):
+        '''
+        Rotate the image like np.rot90(img, self.rotation), into a recycled output buffer.
+        '''
+        rows, cols, channels = img.shape
+        k = self.rotation % 4
+        if k % 2 == 1:
+            rows, cols = cols, rows
+
+        dst = self.__next_out_buf((rows, cols, channels))
+
+        if k == 0:
+            dst[...] = img
+        elif k == 2:
+            cv2.flip(img, -1, dst)
+        else:
+            if self.transposed is None or self.transposed.shape != dst.shape:
+                buffer_pool.release(self.transposed)
+                self.transposed = buffer_pool.get(dst.shape)
+            cv2.transpose(img, self.transposed)
+            # Counterclockwise: flip vertically. Clockwise: flip horizontally.
+            cv2.flip(self.transposed, 0 if k == 1 else 1, dst)
+
+        return dst
+
+    def __next_out_buf(self, shape):
+        '''
+        The returned frames are recycled after self.n_out_bufs newer frames,
+            so readers must finish with a frame well within that time.
+        '''
+        if len(self.out_bufs) >= self.n_out_bufs:
+            buffer_pool.release(self.out_bufs.popleft())
+
+        buf = buffer_pool.get(shape)
+        self.out_bufs.append(buf)
+        return buf
+
+    def read_raw(self):
+        '''
+        In raw mode, return the compressed buffer to be passed to self.decode().
+        Return None if not available.
+        '''
+        # The buffer is handed over to the decoder, so it must not be reused
+        buf = self.__read_hw(reuse=False)
+        if buf is None:
+            time.sleep(0.01)
+        return buf
+
+    def decode(self, buf):
+        '''
+        Decode a buffer returned by self.read_raw() to the properly rotated image.
+        Thread-safe. cv2.imdecode() releases the GIL, so it may run on a worker pool.
+        '''
+        # Some backends ignore the request for raw buffers and deliver decoded images
+        if buf.ndim == 3:
+            return np.rot90(buf, self.rotation)
+
+        img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        if img is None:
+            return self.img_blank
+
+        return np.rot90(img, self.rotation)
+
+    def get_blank(self):
+        return self.img_blank
+
+    def get_largest_size(self):
+        '''
+        Returns:
+            a tuple (width, height) of the (rotated) image in the largest sensor mode
+        '''
+        w, h = self.modes[-1]
+        if self.rotation % 2 == 1:
+            w, h = h, w
+        return (w, h)
+
+    def is_raw(self):
+        return self.isRaw
+
     def set_parameters(self, parameters):
 
         for name, value in parameters.items():
             self.parm_vals[name] = value
 
-        self.__init__config()
+        cap = self.cap
+        if not cap is None:
+            self.__write_changed(cap)
 
     def get_parameters(self):
         return self.parm_vals
 
-    def set_one_parm(self, name, value):
+    def select_mode(self, width, height):
+        '''
+        Select the smallest sensor mode delivering an image of at least the required size.
+        To avoid switching back and forth, a smaller mode than the current one is only selected
+            when it exceeds the requirement by 10%.
+
+        Args:
+            width, height: int, the required size of the (rotated) image returned by self.read()
+
+        Returns:
+            a tuple (width, height) of the sensor mode
+        '''
+        # Convert the image size to the sensor size
+        if self.rotation % 2 == 1:
+            width, height = height, width
+
+        current = self.mode[0] * self.mode[1]
+
+        for w, h in self.modes:
+            margin = 1.1 if w * h < current else 1.0
+            if w >= width * margin and h >= height * margin:
+                return (w, h)
+
+        # Nothing satisfies the requirement, so use the largest mode
+        return self.modes[-1]
+
+    def set_mode(self, mode):
+        '''
+        Switch the sensor mode, only writing to the hardware if it changes.
+
+        Args:
+            mode: a tuple (width, height) returned by self.select_mode()
+        '''
+        self.mode = mode
+
+        # A missing camera delivers a blank of the same size as the other camera's frames
+        self.__resize_blank()
+
+        cap = self.cap
+        if not cap is None:
+            self.__write_changed(cap)
+
+    def check_one_parm(self, name, value):
+        '''
+        Returns:
+            True if the value is allowed for the parameter and the hardware is attached, False otherwise.
+        '''
+        return self.is_valid_parm(name, value) and self.is_attached()
+
+    def is_valid_parm(self, name, value):
+        '''
+        Returns:
+            True if the value is allowed for the parameter, False otherwise.
+        '''
         #                             min   max   increment
         require = {'brightness'    : (0   , 255 , 1),
                    'contrast'      : (0   , 255 , 1),
@@ -105,14 +472,14 @@ class SingleCamera(object):
                        value > max            ,
                        value % increment != 0 ]
 
-        if any(conditions) or self.cap is None:
-            return False
+        return not any(conditions)
 
-        # Update parameter values in this object
-        self.parm_vals[name] = value
+    def set_one_parm(self, name, value):
+
+        if not self.check_one_parm(name, value):
+            return False
 
-        # Finally, set the hardware
-        self.cap.set(self.parm_ids[name], value)
+        self.set_parameters({name: value})
 
         return True
 
@@ -122,6 +489,12 @@ class SingleCamera(object):
     def get_which_cam(self):
         return self.which_cam
 
+    def get_reconnects(self):
+        return self.reconnects
+
+    def is_attached(self):
+        return not self.cap is None
+
     def save_parameters(self):
         filepath = 'parameters/' + self.which_cam + '.json'
         with open(filepath, 'w') as fh:
@@ -129,8 +502,15 @@ class SingleCamera(object):
 
     def close(self):
         self.save_parameters()
-        if not self.cap is None:
-            self.cap.release()
+
+        # A device still being opened is released by the opener thread itself
+        with self.lock:
+            self.isClosing = True
+            cap, self.cap = self.cap, None
+        self.closed.set()
+
+        if not cap is None:
+            cap.release()
 
 
 
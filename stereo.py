@@ -5,18 +5,28 @@ from OpenGL import GL
 class Stereo(object):
 
     @classmethod
-    def compute_depth(self, imgR, imgL, ndisparities, SADWindowSize):
-        # Convert to gray scale
-        imgR_ = cv2.cvtColor(imgR, cv2.COLOR_BGR2GRAY)
-        imgL_ = cv2.cvtColor(imgL, cv2.COLOR_BGR2GRAY)
+    def compute_depth(self, imgR, imgL, ndisparities, SADWindowSize, grayR=None, grayL=None,
+                      disparity=None, depth_map=None):
+        '''
+        Replace the content of imgL with the depth map.
+        The optional gray images, disparity (int16) and depth_map (uint8) buffers are used if provided,
+            so no new arrays are allocated.
+        '''
+        # Convert to gray scale, unless the gray images are provided
+        if grayR is None:
+            grayR = cv2.cvtColor(imgR, cv2.COLOR_BGR2GRAY)
+        if grayL is None:
+            grayL = cv2.cvtColor(imgL, cv2.COLOR_BGR2GRAY)
+        imgR_, imgL_ = grayR, grayL
 
         # Compute stereo disparity
         stereo = cv2.StereoBM(cv2.STEREO_BM_BASIC_PRESET, ndisparities, SADWindowSize)
-        D = stereo.compute(imgL_, imgR_).astype(np.float)
-        depth_map = ( D - np.min(D) ) / ( np.max(D) - np.min(D) ) * 255
+        D = stereo.compute(imgL_, imgR_, disparity)
+
+        # Stretch the disparity to 0..255
+        depth_map = cv2.normalize(D, depth_map, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
 
-        for ch in xrange(3):
-            imgL[:, :, ch] = depth_map.astype(np.uint8)
+        cv2.cvtColor(depth_map, cv2.COLOR_GRAY2BGR, imgL)
 
         return imgL
 
@@ -44,8 +54,9 @@ class Stereo(object):
         imgL_gray = cv2.cvtColor(imgL, cv2.COLOR_BGR2GRAY)
 
         # Compute stereo disparity
-        ndisparities = active_proc_thread.ndisparities # Must be divisible by 16
-        SADWindowSize = active_proc_thread.SADWindowSize # Must be odd, be within 5..255 and be not larger than image width or height
+        config = active_proc_thread.get_config()
+        ndisparities = config.ndisparities # Must be divisible by 16
+        SADWindowSize = config.SADWindowSize # Must be odd, be within 5..255 and be not larger than image width or height
         stereo = cv2.StereoBM(cv2.STEREO_BM_BASIC_PRESET, ndisparities, SADWindowSize)
         disparity = stereo.compute(imgL_gray, imgR_gray)
 
@@ -1,7 +1,14 @@
 from capture_thread import *
 from process_thread import *
+from process_stages import *
 from align_thread import *
 from writer_thread import *
 from cam_select_thread import *
 from cam_tune_thread import *
+from cam_calib_thread import *
+from auto_focus_thread import *
 from cam_equal_thread import *
+from worker_pool import *
+from quality_controller import *
+from frame import *
+from pre_record_buffer import *
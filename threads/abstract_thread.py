@@ -64,6 +64,7 @@ class AbstractThread(threading.Thread):
             # Pausing the loop (or not)
             if self.pausing:
                 self.isPaused = True
+                self.while_paused()
                 time.sleep(self.dt)
                 continue
             else:
@@ -128,6 +129,10 @@ class AbstractThread(threading.Thread):
         'This method must return True/False'
         return True
 
+    def while_paused(self):
+        'Called in every iteration of the paused loop, from the thread itself'
+        pass
+
     def stop(self):
         '''
         To terminate the thread.
@@ -1,13 +1,64 @@
 import numpy as np
-import cv2, time, sys
+import cv2, time, sys, json, collections, bisect
 from abstract_thread import *
 
 
 
+class RollingTrimmedMean(object):
+    '''
+    The mean of the last n values, excluding the lowest and the highest one (outliers).
+
+    The values are kept in arrival order and in sorted order,
+        both updated incrementally as each value comes in and the oldest goes out.
+    '''
+
+    def __init__(self, n):
+        super(RollingTrimmedMean, self).__init__()
+
+        self.values = collections.deque(maxlen=n) # In arrival order
+        self.sorted = [] # In ascending order
+
+    def add(self, value):
+        '''
+        Returns:
+            the updated trimmed mean
+        '''
+        if len(self.values) == self.values.maxlen:
+            oldest = self.values[0]
+            del self.sorted[bisect.bisect_left(self.sorted, oldest)]
+
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+
+        return self.get()
+
+    def get(self):
+        if len(self.sorted) == 0:
+            return 0.0
+
+        # Too few values to exclude any
+        if len(self.sorted) < 3:
+            return float(sum(self.sorted)) / len(self.sorted)
+
+        return float(sum(self.sorted[1:-1])) / (len(self.sorted) - 2)
+
+    def get_latest(self):
+        return self.values[-1]
+
+    def clear(self):
+        self.values.clear()
+        self.sorted = []
+
+
+
 class AlignThread(AbstractThread):
     '''
     This thread runs concurrently with the VideoThread,
     dynamically checking if the stereo pair of images are aligned.
+
+    The full offset detection only runs when the scene changes.
+    Scene changes are detected every frame by the difference between small thumbnails of consecutive images,
+        so the thread costs almost nothing while the stage is static.
     '''
     def __init__(self, process_thread, mediator):
         super(AlignThread, self).__init__()
@@ -20,24 +71,99 @@ class AlignThread(AbstractThread):
                                              'auto_offset_paused' ,
                                              'set_info_text'      ])
 
-        # Construct a queue of offset values
-        self.X = np.zeros((10, ), np.float)
-        self.Y = np.zeros((10, ), np.float)
+        self.__init__parameters()
+
+        # Rolling estimates of the offset values
+        self.X = RollingTrimmedMean(self.history)
+        self.Y = RollingTrimmedMean(self.history)
+
+        # The last frame checked, the gray thumbnail of the previous image, and the difference
+        self.frame = None
+        self.thumb_prev, self.thumb_diff = None, None
+
+        self.pending = True # Whether the offset needs to be detected
+        self.retries = 0 # Detections re-armed by an unsettled offset since the last scene change
+        self.t_detect = 0 # When the offset was last detected
+
+    def __init__parameters(self):
+        '''
+        Load parameters from the parameters/align.json file
+        '''
+        with open('parameters/align.json', 'r') as fh:
+            parms = json.loads(fh.read())
+
+        L = ['poll_fps', # How often to check for scene changes
+             'thumb_width', # Width of the thumbnails for detecting scene changes
+             'change_threshold', # Mean absolute difference of the thumbnails, in gray levels
+             'history', # Number of offset values for the rolling estimate
+             'max_interval', # Detect the offset at least this often (seconds) even if nothing changes
+             'settle_tolerance', # Pixels between the latest offset and the rolling estimate considered settled
+             'max_retries'] # Detections re-armed by an unsettled offset before waiting for a scene change
+
+        for name in L:
+            setattr(self, name, parms[name])
 
     def main(self):
 
-        # Shift the queue by one
-        self.X[1:] = self.X[:-1]
-        self.Y[1:] = self.Y[:-1]
+        t0 = time.time()
+
+        changed = self.detect_change()
+        if changed:
+            self.pending = True
+            self.retries = 0
+
+        if self.pending or t0 - self.t_detect > self.max_interval:
+            # Keep on detecting while the scene changes,
+            #     and once more after it has settled
+            self.pending = changed
+            self.t_detect = t0
+            self.align()
+
+        # Under reduced quality, check for scene changes less frequently
+        factor = self.process_thread.quality.get_align_interval_factor()
+
+        dt = 1.0 / self.poll_fps * factor - (time.time() - t0)
+        if dt > 0:
+            time.sleep(dt)
+
+    def detect_change(self):
+        '''
+        Returns:
+            True if the current image differs significantly from the previous one
+        '''
+        frame = self.process_thread.get_config().cap_thread_R.get_frame()
+
+        # No new frame since the last check
+        if frame is self.frame:
+            return False
+        self.frame = frame
+
+        # The thumbnail is shared with other threads through the frame cache
+        with frame:
+            thumb = frame.get_thumbnail(self.thumb_width)
+
+            if self.thumb_prev is None or self.thumb_prev.shape != thumb.shape:
+                self.thumb_prev = thumb.copy()
+                self.thumb_diff = np.empty_like(thumb)
+                return True
 
-        # Get the current offset value into the queue
-        self.X[0], self.Y[0] = self.process_thread.detect_offset()
+            cv2.absdiff(thumb, self.thumb_prev, self.thumb_diff)
+            energy = cv2.mean(self.thumb_diff)[0]
 
-        # Sort the list of offset values
-        # Remove the lowest and the highest one (outliers)
-        # Average
-        x_avg = np.average(np.sort(self.X)[1:-1])
-        y_avg = np.average(np.sort(self.Y)[1:-1])
+            # Keep a copy, since the frame and its products are recycled
+            self.thumb_prev[...] = thumb
+
+        return energy > self.change_threshold
+
+    def align(self):
+
+        offset = self.process_thread.detect_offset()
+        if offset is None:
+            return
+
+        # Update the rolling estimates with the current offset value
+        x_avg = self.X.add(offset[0])
+        y_avg = self.Y.add(offset[1])
 
         self.emit_info(x_avg, y_avg)
 
@@ -46,13 +172,11 @@ class AlignThread(AbstractThread):
 
         # If the current offset value differs significantly from the average,
         #     meaning that there is more "active movements",
-        # then speed up the loop to get back to a stable condition as soon as possible.
-        if abs(self.Y[0] - y_avg) > 1:
-            time.sleep(0.05)
-        else:
-            # Under stable condition, in which the current offset doesn't differ from the average,
-            # Check alignment every ~1 second.
-            time.sleep(1)
+        # then keep on detecting until getting back to a stable condition.
+        # The retries are bounded, so pixel noise on a static scene does not keep the detection running.
+        if abs(self.Y.get_latest() - y_avg) > self.settle_tolerance and self.retries < self.max_retries:
+            self.retries += 1
+            self.pending = True
 
     def emit_info(self, x_off, y_off):
 
@@ -65,6 +189,14 @@ class AlignThread(AbstractThread):
                                    arg = data )
 
     def before_resuming(self):
+        # Nothing to align with a single camera
+        if self.process_thread.is_mono():
+            return False
+
+        # Start with a fresh detection
+        self.thumb_prev = None
+        self.pending = True
+
         self.mediator.emit_signal('auto_offset_resumed')
         return True
 
@@ -77,11 +209,8 @@ class AlignThread(AbstractThread):
         self.process_thread = thread
 
     def zero_offset(self):
-        self.X = np.zeros((10, ), np.float)
-        self.Y = np.zeros((10, ), np.float)
+        self.X.clear()
+        self.Y.clear()
+        self.pending = True
 
         self.process_thread.set_offset(0, 0)
-
-
-
-
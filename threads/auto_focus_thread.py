@@ -0,0 +1,183 @@
+import numpy as np
+import cv2, time, sys, json
+from abstract_thread import *
+from capture_thread import wait_new_frames
+
+
+
+class FocusSearch(object):
+    '''
+    Coarse-to-fine search for the focus value with the maximum sharpness, for one camera.
+
+    Each pass scans the focus values at a fixed step, within one step of the previous pass around the best value so far.
+    A pass stops early once the sharpness has dropped well below its peak, i.e. the peak has been passed.
+    '''
+
+    def __init__(self, steps, focus_min, focus_max, drop_ratio):
+        super(FocusSearch, self).__init__()
+
+        self.steps = list(steps)
+        self.focus_min = focus_min
+        self.focus_max = focus_max
+        self.drop_ratio = drop_ratio
+
+        self.best_focus = None
+        self.best_sharpness = -1
+        self.isDone = False
+
+        self.__start_pass(focus_min, focus_max)
+
+    def __start_pass(self, lo, hi):
+        self.step = self.steps.pop(0)
+        self.positions = range(lo, hi + 1, self.step)
+        self.i = 0
+        self.peak = -1 # The peak sharpness of this pass
+
+    def get_next(self):
+        '''
+        Returns:
+            int, the next focus value to be measured, or None if the search is done
+        '''
+        if self.isDone:
+            return None
+        return self.positions[self.i]
+
+    def report(self, sharpness):
+        '''
+        Report the sharpness measured at the focus value from self.get_next()
+        '''
+        focus = self.positions[self.i]
+        self.i += 1
+
+        self.peak = max(self.peak, sharpness)
+
+        if sharpness > self.best_sharpness:
+            self.best_focus, self.best_sharpness = focus, sharpness
+
+        passed_peak = sharpness < self.peak * self.drop_ratio
+
+        if not passed_peak and self.i < len(self.positions):
+            return
+
+        if len(self.steps) == 0:
+            self.isDone = True
+            return
+
+        # The next, finer pass around the best value
+        self.__start_pass(max(self.focus_min, self.best_focus - self.step),
+                          min(self.focus_max, self.best_focus + self.step))
+
+    def get_best(self):
+        return self.best_focus
+
+
+
+class AutoFocusThread(AbstractThread):
+    '''
+    This thread is associated with (and dependent on) the CaptureThread object, like the CamTuneThread.
+
+    Each time it's resumed, it focuses the cameras in parallel by hill-climbing the sharpness,
+        i.e. the variance of the Laplacian of the downsampled ROI from the frame cache,
+        then pauses itself.
+    Focus values are applied by the capture threads between frames, so capturing never stalls.
+    '''
+
+    def __init__(self, cap_thread_R, cap_thread_L, mediator):
+
+        super(AutoFocusThread, self).__init__()
+
+        self.cap_thread_R = cap_thread_R
+        self.cap_thread_L = cap_thread_L
+        self.mediator = mediator
+
+        self.connect_signals(mediator = mediator,
+                             signal_names = ['set_info_text'  ,
+                                             'update_cam_parm'])
+
+        self.__init__parameters()
+
+    def __init__parameters(self):
+
+        with open('parameters/auto_focus.json', 'r') as fh:
+            parms = json.loads(fh.read())
+
+        L = ['focus_min',
+             'focus_max',
+             'steps', # The focus step of each pass, coarse to fine
+             'drop_ratio', # A pass stops once the sharpness drops below this ratio of its peak
+             'pyramid_level', # Measure sharpness on the gray image downscaled by 2^pyramid_level
+             'settle_frames', # Frames to wait for a focus change to take effect
+             'settle_timeout']
+
+        for name in L:
+            setattr(self, name, parms[name])
+
+    def main(self):
+
+        t0 = time.time()
+
+        cap_threads = []
+        for thread in [self.cap_thread_R, self.cap_thread_L]:
+            if not thread in cap_threads:
+                cap_threads.append(thread)
+
+        searches = {}
+        for thread in cap_threads:
+            searches[thread] = FocusSearch(self.steps, self.focus_min, self.focus_max, self.drop_ratio)
+
+        # All cameras step in lockstep, so they share the waits for new frames
+        while not self.pausing and not self.stopping:
+
+            active = [t for t in cap_threads if not searches[t].isDone]
+            if len(active) == 0:
+                break
+
+            for thread in active:
+                thread.set_one_cam_parm('focus', searches[thread].get_next())
+
+            wait_new_frames(active, self.settle_frames, self.settle_timeout)
+
+            for thread in active:
+                # Keep the pyramid pooled while it is computed
+                with thread.get_frame() as frame:
+                    searches[thread].report(frame.get_sharpness(level = self.pyramid_level))
+
+        for thread in cap_threads:
+            focus = searches[thread].get_best()
+            if focus is None:
+                continue
+            thread.set_one_cam_parm('focus', focus)
+            self.update_gui(thread, focus)
+
+        self.emit_info(searches, time.time() - t0)
+
+        # Done, wait for the next resume()
+        self.pausing = True
+
+    def emit_info(self, searches, dt):
+
+        texts = []
+        for thread, search in searches.items():
+            texts.append('{} {}'.format(thread.get_which_cam(), search.get_best()))
+
+        text = 'Auto focus: {} in {:.2f} s'.format(', '.join(texts), dt)
+
+        data = {'line': 8,
+                'text': text}
+
+        self.mediator.emit_signal( signal_name = 'set_info_text',
+                                   arg = data )
+
+    def update_gui(self, thread, focus):
+
+        data = {'which_cam': thread.get_which_cam(),
+                'name'     : 'focus'                ,
+                'value'    : focus                  }
+
+        self.mediator.emit_signal('update_cam_parm', data)
+
+    # Public methods
+
+    def set_cap_threads(self, thread_R, thread_L):
+        self.cap_thread_R = thread_R
+        self.cap_thread_L = thread_L
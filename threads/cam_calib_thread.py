@@ -0,0 +1,148 @@
+import numpy as np
+import cv2, time, sys, threading, json
+from capture_thread import wait_new_frames
+from camera_response import ResponseTable
+
+
+
+class CamCalibThread(threading.Thread):
+    '''
+    Sweeps gain and exposure of the cameras, all in parallel,
+        and records the mean brightness at each setting into a ResponseTable per camera.
+
+    The original gain and exposure are restored afterwards.
+    Runs once, like the CamSelectThread.
+
+    The table of a camera is only saved if every setting was applied and took effect in time,
+        and the brightness increases with the gain, so a detached camera never overwrites a good table.
+    The cameras which failed are passed with the 'calibration_done' signal.
+    '''
+
+    def __init__(self, cap_threads, mediator):
+        '''
+        Args:
+            cap_threads: a list of the CaptureThread objects of the cameras to be calibrated
+        '''
+        super(CamCalibThread, self).__init__()
+
+        self.cap_threads = cap_threads
+        self.mediator = mediator
+
+        self.__init__parameters()
+
+        self.__init__signals()
+
+    def __init__parameters(self):
+
+        with open('parameters/auto_cam.json', 'r') as fh:
+            parms = json.loads(fh.read())
+
+        self.gains = range(parms['calibration_gain_min'], parms['calibration_gain_max'] + 1, parms['calibration_gain_step'])
+        self.exposures = range(parms['exposure_min'], parms['exposure_max'] + 1)
+
+        self.settle_frames = parms['settle_frames']
+        self.exposure_settle_frames = parms['exposure_settle_frames']
+        self.settle_timeout = parms['settle_timeout']
+
+        # The brightness noise allowed when checking that it increases with the gain
+        self.tolerance = parms['tolerance']
+
+    def __init__signals(self, connect=True):
+        '''
+        Call the mediator to connect signals to the gui.
+
+        The parameter 'connect' specifies whether connect or disconnect signals.
+        '''
+        signal_names = ['progress_update', 'calibration_done']
+
+        if connect:
+            self.mediator.connect_signals(signal_names)
+        else:
+            self.mediator.disconnect_signals(signal_names)
+
+    def run(self):
+
+        originals = {}
+        for t in self.cap_threads:
+            originals[t] = {'gain'    : t.get_one_cam_parm('gain'),
+                            'exposure': t.get_one_cam_parm('exposure')}
+
+        means = dict((t, []) for t in self.cap_threads)
+        failed = set()
+
+        n_total = len(self.gains) * len(self.exposures)
+        n_done = 0
+
+        for exposure in self.exposures:
+
+            for t in self.cap_threads:
+                if not t.set_one_cam_parm('exposure', exposure):
+                    failed.add(t)
+                means[t].append([])
+
+            for i, gain in enumerate(self.gains):
+
+                for t in self.cap_threads:
+                    if not t.set_one_cam_parm('gain', gain):
+                        failed.add(t)
+
+                # An exposure change takes longer to take effect
+                if i == 0:
+                    n_frames = self.exposure_settle_frames
+                else:
+                    n_frames = self.settle_frames
+                failed.update(wait_new_frames(self.cap_threads, n_frames, self.settle_timeout))
+
+                for t in self.cap_threads:
+                    means[t][-1].append(t.get_frame().get_roi_mean())
+
+                n_done += 1
+                # The progress bar hides itself at 100
+                self.mediator.emit_signal( signal_name = 'progress_update',
+                                                   arg = ('Calibrating camera response', min(99, 100 * n_done / n_total)) )
+
+        for t in self.cap_threads:
+            t.set_camera_parameters(originals[t])
+
+            if t in failed or not self.is_monotonic(means[t]):
+                print 'Calibration of camera {} failed, its response table is not saved'.format(t.get_which_cam())
+                failed.add(t)
+                continue
+
+            table = ResponseTable(which_cam = t.get_which_cam(),
+                                  gains     = self.gains,
+                                  exposures = self.exposures,
+                                  means     = means[t])
+            table.save()
+
+        self.mediator.emit_signal( signal_name = 'progress_update',
+                                           arg = ('Calibrating camera response', 100) )
+
+        self.mediator.emit_signal( signal_name = 'calibration_done',
+                                           arg = sorted(t.get_which_cam() for t in failed) )
+
+        # Pause a short bit of time before disconnecting the signal
+        # Without this pause, often the signal will not be successfully sent
+        time.sleep(0.1)
+
+        self.__init__signals(connect=False)
+
+    def is_monotonic(self, means):
+        '''
+        Args:
+            means: a list of lists, the brightness at each exposure (outer) and gain (inner)
+
+        Returns:
+            True if the brightness increases with the gain at every exposure, allowing for noise,
+                False otherwise, e.g. flat for a blank image
+        '''
+        for row in means:
+            row = np.array(row)
+            if np.any(np.diff(row) < -self.tolerance):
+                return False
+
+            # Flat all the way, unless saturated or black at this exposure
+            if row[-1] - row[0] <= self.tolerance and row[0] > self.tolerance and row[-1] < 255 - self.tolerance:
+                return False
+
+        return True
@@ -1,5 +1,6 @@
 import numpy as np
 import cv2, time, sys, threading
+from camera_enum import CameraEnumerator
 
 
 
@@ -30,26 +31,20 @@ class CamSelectThread(threading.Thread):
             self.mediator.disconnect_signals(signal_names)
 
     def run(self):
-        for id in range(10):
+        # List the devices from the OS and probe them all in parallel,
+        #     instead of opening candidate ids one by one
+        enumerator = CameraEnumerator()
+        devices = enumerator.probe(enumerator.list_devices())
 
-            self.isWaiting = True
-
-            cap = cv2.VideoCapture(id)
-
-            if cap.isOpened():
-                ret, img = cap.read()
+        for data in devices:
 
-                data = {'id': id, 'img': img}
-
-                cap.release()
-
-                self.mediator.emit_signal( signal_name = 'show_current_cam',
-                                                   arg = data)
-                while self.isWaiting:
-                    time.sleep(0.1)
+            self.isWaiting = True
 
-            else:
-                print 'Camera id: {} not available'.format(id)
+            # data = {'id': int, 'device': str, 'name': str, 'img': numpy array}
+            self.mediator.emit_signal( signal_name = 'show_current_cam',
+                                               arg = data)
+            while self.isWaiting:
+                time.sleep(0.1)
 
         self.mediator.emit_signal( signal_name = 'select_cam_done' )
 
@@ -1,6 +1,54 @@
 import numpy as np
 import cv2, time, sys, math, json
 from abstract_thread import *
+from capture_thread import wait_new_frames
+from camera_response import ResponseTable
+
+
+
+class GainModel(object):
+    '''
+    Online linear model of image brightness versus gain at a fixed exposure, i.e. mean = a * gain + b.
+
+    Fitted by exponentially weighted least squares, so older observations fade out as the scene changes.
+    Until enough distinct gains have been observed, brightness is assumed to be proportional to gain.
+    '''
+
+    def __init__(self, forgetting):
+        super(GainModel, self).__init__()
+
+        self.forgetting = forgetting # Weight of older observations, 0..1
+
+        # Weighted sums of 1, gain, mean, gain^2, gain*mean
+        self.sw, self.sx, self.sy, self.sxx, self.sxy = 0.0, 0.0, 0.0, 0.0, 0.0
+
+    def add(self, gain, mean):
+        f = self.forgetting
+        self.sw  = f * self.sw  + 1
+        self.sx  = f * self.sx  + gain
+        self.sy  = f * self.sy  + mean
+        self.sxx = f * self.sxx + gain * gain
+        self.sxy = f * self.sxy + gain * mean
+
+    def predict_gain(self, target, gain, mean):
+        '''
+        Args:
+            target: float, the target brightness
+            gain, mean: the current gain and brightness
+
+        Returns:
+            float, the gain expected to give the target brightness
+        '''
+        # Weighted variance of the observed gains, times sw^2
+        var = self.sw * self.sxx - self.sx * self.sx
+
+        if var > self.sw * self.sw:
+            a = (self.sw * self.sxy - self.sx * self.sy) / var
+            if a > 0:
+                b = (self.sy - a * self.sx) / self.sw
+                return (target - b) / a
+
+        return gain * target / max(mean, 1.0)
 
 
 
@@ -39,15 +87,33 @@ class CamTuneThread(AbstractThread):
              'gain_max',
              'gain_min',
              'exposure_max',
-             'exposure_min']
+             'exposure_min',
+             'histogram_step', # Subsample every n-th row and column for metering
+             'saturation_level', # Gray levels at or above are clipped highlights
+             'max_saturation', # Fraction of clipped highlights tolerated
+             'saturation_backoff', # Darken by this ratio if there are too many clipped highlights
+             'forgetting', # Weight of older observations in the gain model
+             'settle_frames', # Frames to wait for a gain change to take effect
+             'exposure_settle_frames', # Frames to wait for an exposure change to take effect
+             'settle_timeout'] # Maximum seconds to wait for the frames
 
         for name in L:
             setattr(self, name, parms[name])
 
+        # The gain models of the right camera, keyed by exposure value
+        self.models = {}
+
+        # The response tables of the cameras, keyed by which_cam, loaded when first needed
+        self.tables = {}
+        self.reset_table_lookup()
+
+        self.levels = np.arange(256, dtype=np.float32)
+
     def main(self):
-        # The default sleep time is 1 second
-        # The following methods decide whether to speed up or not
+        # By default sleep for 1 second
+        # The following methods decide whether to speed up, i.e. only wait for changes to take effect
         self.sleep_time = 1
+        self.n_settle = 0
 
         # ------ RIGHT Camera ------ #
         # Check gain and exposure value of the right camera
@@ -56,12 +122,17 @@ class CamTuneThread(AbstractThread):
         self.tune_right_camera()
 
         # ------ LEFT Camera ------ #
-        # Copy and apply right camera parameters to the left camera
-        self.copy_parameters()
-        # The main method to equlaize the left camera to the right one
-        self.tune_left_camera()
-
-        time.sleep(self.sleep_time)
+        # In the mono mode there is no other camera to equalize
+        if not self.is_mono():
+            # Copy and apply right camera parameters to the left camera
+            self.copy_parameters()
+            # The main method to equlaize the left camera to the right one
+            self.tune_left_camera()
+
+        if self.n_settle > 0:
+            self.wait_settled(self.n_settle)
+        else:
+            time.sleep(self.sleep_time)
 
     # Procedural blocks in self.main()
 
@@ -80,75 +151,109 @@ class CamTuneThread(AbstractThread):
             self.set_cam(isRight=True, name='exposure', value=self.exposure_max)
 
     def tune_right_camera(self):
+        '''
+        Jump the gain close to the brightness goal in one step, as predicted by the model of brightness versus gain.
+        If the predicted gain is out of range, change the exposure as well,
+            assuming each exposure step doubles or halves the brightness.
+        '''
 
         gain = self.cap_thread_R.get_one_cam_parm('gain')
         exposure = self.cap_thread_R.get_one_cam_parm('exposure')
-        img = self.get_roi(self.cap_thread_R.get_image())
-        mean = np.average(img)
+        with self.cap_thread_R.get_frame() as frame:
+            mean, saturated = self.meter(frame)
 
         self.emit_info_R(mean)
 
-        diff = self.goal - mean
+        model = self.get_model(exposure)
+        model.add(gain, mean)
+
+        # Clipped highlights make the mean underestimate the brightness,
+        #     so darken by a fixed ratio until they're gone
+        if saturated > self.max_saturation:
+            target = mean * self.saturation_backoff
 
         # Do nothing if difference is within tolerated range, so return
-        if abs(diff) <= self.tolerance:
+        # Also don't brighten if that would bring the clipped highlights back
+        elif abs(self.goal - mean) <= self.tolerance or \
+             (mean < self.goal and saturated > self.max_saturation / 2):
             # Update the gui to display the correct values
             self.update_gui(isRight=True, name='gain', value=gain)
             self.update_gui(isRight=True, name='exposure', value=exposure)
             return
 
+        else:
+            target = self.goal
+
         gain_min = self.gain_min
         gain_max = self.gain_max
         expo_min = self.exposure_min
         expo_max = self.exposure_max
 
-        # ------ Adjusting GAIN ------ #
-        # Dynamically adjust gain according to the difference
-        if diff > self.tolerance:
-            gain += (int(diff * self.learn_rate) + 1)
-        elif diff < (-1 * self.tolerance):
-            gain += (int(diff * self.learn_rate) - 1)
-
         # ------ Set GAIN ------ #
-        # If the adjusted gain is within the allowed range
-        # Set gain and speed up to move on to the next iteration
-        if gain >= gain_min and gain <= gain_max:
-            self.set_cam(isRight=True, name='gain', value=gain)
-            self.speed_up()
+        # If the predicted gain is within the allowed range
+        # Set gain and wait for it to take effect
+        new_gain = model.predict_gain(target, gain, mean)
+
+        if new_gain >= gain_min and new_gain <= gain_max:
+            self.set_cam(isRight=True, name='gain', value=int(round(new_gain)))
+            self.speed_up(self.settle_frames)
             return
 
         # ------ GAIN out of range  ------ #
         # ------ Adjusting EXPOSURE ------ #
-        # If gain out of range, adjust exposure
-        if gain > gain_max:
-            exposure = exposure - 1 # exposure brighter
-            # Update the gui to display the boundary (max) value
-            self.update_gui(isRight=True, name='gain', value=gain_max)
-        elif gain < gain_min:
-            exposure = exposure + 1 # exposure darker
-            # Update the gui to display the boundary (min) value
-            self.update_gui(isRight=True, name='gain', value=gain_min)
+        # The number of exposure steps to bring the gain back to the mid value
+        # exposure - 1 is brighter
+        gain_mid = (gain_min + gain_max) / 2
+        steps = int(round(math.log(max(new_gain, 1.0) / gain_mid, 2)))
+        if steps == 0:
+            steps = 1 if new_gain > gain_max else -1
+
+        new_exposure = min(max(exposure - steps, expo_min), expo_max)
+
+        # The gain for the new exposure, as close as possible to the target
+        new_gain = new_gain / 2 ** (exposure - new_exposure)
+        new_gain = int(round(min(max(new_gain, gain_min), gain_max)))
 
         # ------ Set EXPOSURE ------ #
-        # If the adjusted exposure is within the allowed range
-        # Set exposure and speed up to move on to the next iteration
-        if exposure >= expo_min and exposure <= expo_max:
-            gain = (self.gain_min + self.gain_max) / 2 # Since gain is out of range, set it to the mid value
-            self.set_cam(isRight=True, name='gain', value=gain)
-            self.set_cam(isRight=True, name='exposure', value=exposure)
-            time.sleep(0.1) # Takes a while before the exposure change takes effect
-            self.speed_up()
+        if new_exposure != exposure:
+            self.set_cam(isRight=True, name='exposure', value=new_exposure)
+            self.set_cam(isRight=True, name='gain', value=new_gain)
+            # Takes a while before the exposure change takes effect
+            self.speed_up(self.exposure_settle_frames)
             return
 
         # ------ EXPOSURE out of range ------ #
-        # ------ Do nothing in the end ------ #
-        # Nothing to do if the exposure is out of range, so slow down and return
-        if exposure > expo_max:
-            # Update the gui to display the boundary (max) value
-            self.update_gui(isRight=True, name='exposure', value=expo_max)
-        elif exposure < expo_min:
-            # Update the gui to display the boundary (min) value
-            self.update_gui(isRight=True, name='exposure', value=expo_min)
+        # Get as close as possible with the gain at its boundary value
+        if new_gain != gain:
+            self.set_cam(isRight=True, name='gain', value=new_gain)
+            self.speed_up(self.settle_frames)
+        self.update_gui(isRight=True, name='exposure', value=exposure)
+
+    def meter(self, frame):
+        '''
+        Meter the brightness from the histogram of the subsampled ROI.
+
+        Returns:
+            a tuple (mean, saturated)
+                mean: float, the mean brightness over all channels
+                saturated: float, the fraction of clipped highlights
+        '''
+        hist = frame.get_histogram(step = self.histogram_step).sum(axis=0)
+        total = max(hist.sum(), 1.0)
+
+        mean = np.dot(hist, self.levels) / total
+        saturated = hist[self.saturation_level:].sum() / total
+
+        return mean, saturated
+
+    def get_model(self, exposure):
+        '''
+        Returns:
+            the GainModel of the right camera at the exposure value
+        '''
+        if not exposure in self.models:
+            self.models[exposure] = GainModel(self.forgetting)
+        return self.models[exposure]
 
     def copy_parameters(self):
         '''
@@ -171,11 +276,9 @@ class CamTuneThread(AbstractThread):
 
         # Get the current gain value of the left camera
         gain_L = self.cap_thread_L.get_one_cam_parm(name='gain')
-        imgR = self.get_roi(self.cap_thread_R.get_image())
-        imgL = self.get_roi(self.cap_thread_L.get_image())
-
-        mean_R = np.average(imgR)
-        mean_L = np.average(imgL)
+        # The ROI means are shared with other threads through the frame cache
+        mean_R = self.cap_thread_R.get_frame().get_roi_mean()
+        mean_L = self.cap_thread_L.get_frame().get_roi_mean()
 
         self.emit_info_L(mean_L)
 
@@ -187,6 +290,22 @@ class CamTuneThread(AbstractThread):
             self.update_gui(isRight=False, name='gain', value=gain_L)
             return
 
+        # With calibrated cameras, jump to the equalizing gain by table lookup,
+        #     but only when the right camera has changed since the last lookup.
+        # In between, refine by feedback from the images, and keep the error of the table as a correction,
+        #     so a table which is off, e.g. calibrated on another scene, cannot make the gain flip back and forth.
+        key = (self.cap_thread_R.get_one_cam_parm('gain'), self.cap_thread_R.get_one_cam_parm('exposure'))
+        if key != self.table_key_L:
+            self.table_key_L = key
+            self.gain_table_L = self.match_gain_L()
+
+            if not self.gain_table_L is None:
+                gain = self.gain_table_L + self.gain_correction_L
+                if gain != gain_L and gain >= 0 and gain <= 127:
+                    self.set_cam(isRight=False, name='gain', value=gain)
+                    self.speed_up()
+                    return
+
         # Adjust gain_L according to the difference of image brightness
         if diff > self.tolerance:
             gain_L += (int(diff * self.learn_rate) + 1)
@@ -208,10 +327,72 @@ class CamTuneThread(AbstractThread):
             self.set_cam(isRight=False, name='gain', value=gain_L)
             self.speed_up()
 
+            if not self.gain_table_L is None:
+                self.gain_correction_L = gain_L - self.gain_table_L
+
     # Lower-level methods used in the procedural blocks
 
-    def speed_up(self):
-        self.sleep_time = 0.05
+    def is_mono(self):
+        return self.cap_thread_R is self.cap_thread_L
+
+    def speed_up(self, n_frames=None):
+        '''
+        Instead of sleeping, only wait for n_frames new frames, so the changes show in the next iteration.
+        '''
+        if n_frames is None:
+            n_frames = self.settle_frames
+        self.n_settle = max(self.n_settle, n_frames)
+
+    def wait_settled(self, n_frames):
+        '''
+        Wait until each active camera has captured n_frames new frames, up to self.settle_timeout.
+        '''
+        wait_new_frames([self.cap_thread_R, self.cap_thread_L], n_frames, self.settle_timeout)
+
+    def load_response_tables(self):
+        '''
+        (Re)load the response tables of the cameras, e.g. after calibration.
+        '''
+        self.tables = {}
+        self.reset_table_lookup()
+
+    def reset_table_lookup(self):
+        '''
+        Forget the last table lookup for the left camera and the correction learned for it.
+        '''
+        self.table_key_L = None # (gain, exposure) of the right camera at the last lookup
+        self.gain_table_L = None # The gain of the left camera given by the last lookup
+        self.gain_correction_L = 0 # Added to the table gain, learned by feedback
+
+    def get_response_table(self, cap_thread):
+        '''
+        Returns:
+            the ResponseTable of the camera, or None if not calibrated
+        '''
+        which_cam = cap_thread.get_which_cam()
+        if not which_cam in self.tables:
+            self.tables[which_cam] = ResponseTable.load(which_cam)
+        return self.tables[which_cam]
+
+    def match_gain_L(self):
+        '''
+        Returns:
+            int, the gain of the left camera equalizing the right camera by table lookup,
+                or None if either camera has not been calibrated
+        '''
+        table_R = self.get_response_table(self.cap_thread_R)
+        table_L = self.get_response_table(self.cap_thread_L)
+        if table_R is None or table_L is None:
+            return None
+
+        gain_R = self.cap_thread_R.get_one_cam_parm('gain')
+        exposure = self.cap_thread_R.get_one_cam_parm('exposure')
+
+        gain_L = table_L.match_gain(table_R, gain_R, exposure)
+        if gain_L is None:
+            return None
+
+        return int(round(gain_L))
 
     def emit_info_R(self, mean):
 
@@ -254,17 +435,6 @@ class CamTuneThread(AbstractThread):
 
         self.mediator.emit_signal('update_cam_parm', data)
 
-    def get_roi(self, img):
-
-        rows, cols, channels = img.shape
-
-        A = rows * 1 / 4
-        B = rows * 3 / 4
-        C = cols * 1 / 4
-        D = cols * 3 / 4
-
-        return img[A:B, C:D, :]
-
     # Overriden methods
 
     def before_resuming(self):
@@ -280,4 +450,5 @@ class CamTuneThread(AbstractThread):
     def set_cap_threads(self, thread_R, thread_L):
         self.cap_thread_R = thread_R
         self.cap_thread_L = thread_L
+        self.reset_table_lookup()
 
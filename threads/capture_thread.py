@@ -1,15 +1,68 @@
 import numpy as np
-import cv2, time, sys, threading, json
+import cv2, time, sys, threading, json, collections
 from constants import *
 from abstract_thread import *
+from frame import *
+
+
+
+class NewFrameCounter(object):
+    '''
+    Counts the new frames captured by each of the capture threads, by polling update().
+    For a thread which must not block while waiting, see wait_new_frames() otherwise.
+    '''
+
+    def __init__(self, cap_threads):
+        super(NewFrameCounter, self).__init__()
+
+        self.threads = set(cap_threads)
+        self.frames = dict((t, t.get_frame()) for t in self.threads)
+        self.counts = dict((t, 0) for t in self.threads)
+
+    def update(self):
+        for t in self.threads:
+            frame = t.get_frame()
+            if not frame is self.frames[t]:
+                self.frames[t] = frame
+                self.counts[t] += 1
+
+    def get_short(self, n_frames):
+        '''
+        Returns:
+            a list of the capture threads which have not captured n_frames yet, empty if all have
+        '''
+        return [t for t in self.threads if self.counts[t] < n_frames]
+
+
+
+def wait_new_frames(cap_threads, n_frames, timeout):
+    '''
+    Wait until each of the capture threads has captured n_frames new frames, up to timeout seconds.
+    Used to let camera parameter changes take effect.
+
+    Returns:
+        a list of the capture threads which have not captured n_frames in time, empty if all have
+    '''
+    counter = NewFrameCounter(cap_threads)
+
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        counter.update()
+        if not counter.get_short(n_frames):
+            return []
+
+        time.sleep(0.005)
+
+    return counter.get_short(n_frames)
 
 
 
 class CaptureThread(AbstractThread):
 
-    def __init__(self, camera, mediator):
+    def __init__(self, camera, mediator, decode_pool=None):
         '''
-        which_cam: could be one of the three constants [CAM_R, CAM_L or CAM_E]
+        camera: the SingleCamera object
+        decode_pool: the WorkerPool object decoding raw frames, only used if the camera is in raw mode
         '''
         super(CaptureThread, self).__init__()
 
@@ -18,17 +71,89 @@ class CaptureThread(AbstractThread):
         self.mediator = mediator
         self.connect_signals(mediator, ['set_info_text'])
 
-        self.img = self.cam.read()
+        # In raw mode, frame N is decoded on the pool while frame N+1 is being captured.
+        # The pool is shared by all capture threads, so the decoding of right and left frames overlaps.
+        if self.cam.is_raw():
+            self.decode_pool = decode_pool
+        else:
+            self.decode_pool = None
+        self.decode_job = None
+        self.decode_time = 0
+
+        self.img = self.cam.get_blank()
+
+        # The latest frames, whose cached products are released when they are recycled
+        with open('parameters/capture.json', 'r') as fh:
+            capture_parms = json.loads(fh.read())
+        self.frame = Frame(self.img)
+        self.frames = collections.deque([self.frame])
+        self.n_frames_kept = capture_parms['ring_slots']
 
         self.t_series = [time.clock() for i in range(30)]
 
+        # Camera parameters submitted by other threads, waiting to be applied by this thread.
+        # Keyed by parameter name, so rapid updates of the same parameter coalesce into one hardware write.
+        self.pending_parms = {}
+        self.pending_mode = None
+        self.pending_lock = threading.Lock()
+
     def main(self):
 
+        # Apply camera parameters between frames, never concurrently with cam.read()
+        self.apply_pending_parameters()
+
         # Read the images from the cameras
-        self.img = self.cam.read()
+        if self.decode_pool is None:
+            self.img = self.cam.read()
+        else:
+            self.read_and_decode()
+
+        self.update_frame()
 
         self.emit_fps_info()
 
+    def read_and_decode(self):
+        '''
+        Read the raw frame, collect the previous frame from the decode pool, and submit the raw frame.
+        '''
+        buf = self.cam.read_raw()
+
+        if not self.decode_job is None:
+            self.img, self.decode_time = self.decode_job.wait()
+            self.decode_job = None
+
+        if buf is None:
+            self.img = self.cam.get_blank()
+            return
+
+        self.decode_job = self.decode_pool.submit(self.decode, buf)
+
+    def decode(self, buf):
+        '''
+        Runs on the decode pool.
+
+        Returns:
+            a tuple (image, decoding time in seconds)
+        '''
+        t0 = time.time()
+        img = self.cam.decode(buf)
+        return img, time.time() - t0
+
+    def update_frame(self):
+        '''
+        Wrap a new image into a Frame. The same image, e.g. the blank one, keeps its frame and cached products.
+        '''
+        if self.img is self.frame.img:
+            return
+
+        frame = Frame(self.img)
+        self.frames.append(frame)
+        self.frame = frame
+
+        # Frames are recycled in step with the camera's output buffers
+        if len(self.frames) > self.n_frames_kept:
+            self.frames.popleft().release()
+
     def emit_fps_info(self):
         '''
         Emits real-time frame-rate info to the gui
@@ -48,7 +173,10 @@ class CaptureThread(AbstractThread):
         line = {CAM_R: 0, CAM_L: 1, CAM_E: 2}
 
         which_cam = self.cam.get_which_cam() # CAM_R, CAM_L or CAM_E
-        text = 'Capture thread {}: {} fps'.format(which_cam, rate)
+        text = 'Capture thread {}: {} fps, {} reconnects'.format(which_cam, rate, self.cam.get_reconnects())
+
+        if not self.decode_pool is None:
+            text = text + ', decode {:.1f} ms'.format(self.decode_time * 1000)
 
         data = {'line': line[which_cam],
                 'text': text}
@@ -56,27 +184,90 @@ class CaptureThread(AbstractThread):
         self.mediator.emit_signal( signal_name = 'set_info_text',
                                    arg = data )
 
+    def apply_pending_parameters(self):
+        '''
+        Apply the submitted camera parameters. Only called from this thread.
+        '''
+        with self.pending_lock:
+            parameters, self.pending_parms = self.pending_parms, {}
+            mode, self.pending_mode = self.pending_mode, None
+
+        if not mode is None:
+            self.cam.set_mode(mode)
+
+        if parameters:
+            self.cam.set_parameters(parameters)
+
+    def while_paused(self):
+        # Keep applying submitted parameters while not capturing
+        self.apply_pending_parameters()
+
+    def after_stopped(self):
+        # The main loop has exited, so apply the remaining parameters before the camera is closed and saved
+        self.apply_pending_parameters()
+        return True
+
     def get_image(self):
         return self.img
 
+    def get_frame(self):
+        '''
+        Returns:
+            the latest Frame object, sharing its derived products (gray, pyramid, histograms, ROI means) among threads
+        '''
+        return self.frame
+
     def set_camera_parameters(self, parameters):
+        '''
+        Submit camera parameters to be applied by this thread between frames.
+        '''
+        if self.cam:
+            with self.pending_lock:
+                self.pending_parms.update(parameters)
 
+    def request_source_size(self, width, height):
+        '''
+        Submit the image size required by the downstream pipeline.
+        The camera switches to the smallest sensor mode satisfying it, between frames.
+        '''
         if self.cam:
-            self.cam.set_parameters(parameters)
+            mode = self.cam.select_mode(width, height)
+            with self.pending_lock:
+                self.pending_mode = mode
 
-    def get_camera_parameters(self):
+    def get_largest_size(self):
+        '''
+        Returns:
+            a tuple (width, height) of the image in the largest sensor mode, e.g. for native recording
+        '''
+        return self.cam.get_largest_size()
 
+    def get_camera_parameters(self):
+        '''
+        Returns:
+            a dictionary of the camera parameters, including the ones not applied yet
+        '''
         if self.cam:
-            return self.cam.get_parameters()
+            with self.pending_lock:
+                parameters = dict(self.cam.get_parameters())
+                parameters.update(self.pending_parms)
+            return parameters
 
     def set_one_cam_parm(self, name, value):
 
         if self.cam:
-            return self.cam.set_one_parm(name, value)
+            if not self.cam.check_one_parm(name, value):
+                return False
+
+            self.set_camera_parameters({name: value})
+            return True
 
     def get_one_cam_parm(self, name):
 
         if self.cam:
+            with self.pending_lock:
+                if name in self.pending_parms:
+                    return self.pending_parms[name]
             return self.cam.get_one_parm(name)
 
     def get_which_cam(self):
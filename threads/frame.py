@@ -0,0 +1,208 @@
+import numpy as np
+import cv2, threading
+from buffer_pool import buffer_pool
+
+
+
+# The central half of the image, as fractions (top, bottom, left, right)
+CENTER_ROI = (0.25, 0.75, 0.25, 0.75)
+
+
+
+class Frame(object):
+    '''
+    A captured image with a cache of its derived products,
+        e.g. the gray image, a downscaled pyramid, channel histograms and ROI means.
+
+    Each product is computed on the first request and memoized,
+        so all threads reading the same frame share one computation.
+    The buffers of the products come from the buffer pool
+        and are returned to it when the last reference to the frame is released.
+
+    The capture thread holds one reference until it recycles the frame.
+    Threads reading array products, e.g. the gray image or a histogram, hold another one while using them:
+
+        with cap_thread.get_frame() as frame:
+            gray = frame.get_gray()
+            ...
+
+    Scalar products, e.g. ROI means, are computed under the lock, so they need no reference.
+    Without any reference, products are neither pooled nor cached.
+    '''
+
+    def __init__(self, img):
+        super(Frame, self).__init__()
+
+        self.img = img
+
+        self.cache = {} # key: (product name, arguments), value: the product
+        self.buffers = [] # Pool buffers held by the products
+        self.refs = 1 # Held by the capture thread
+        self.lock = threading.RLock() # Products may be computed from other products
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __get(self, key, compute):
+        '''
+        Returns:
+            the memoized product, computed by compute() if not yet available
+        '''
+        with self.lock:
+            # Nobody would release the buffers of the product
+            if self.refs == 0:
+                return compute()
+            if not key in self.cache:
+                self.cache[key] = compute()
+            return self.cache[key]
+
+    def __buffer(self, shape, dtype=np.uint8):
+        if self.refs == 0:
+            return np.empty(shape, dtype)
+        buf = buffer_pool.get(shape, dtype)
+        self.buffers.append(buf)
+        return buf
+
+    def get_image(self):
+        return self.img
+
+    def get_gray(self):
+        return self.__get(('gray', ), self.__compute_gray)
+
+    def __compute_gray(self):
+        rows, cols, _ = self.img.shape
+        gray = self.__buffer((rows, cols))
+        cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY, gray)
+        return gray
+
+    def get_pyramid(self, level):
+        '''
+        Returns:
+            the gray image downscaled by 2^level
+        '''
+        if level == 0:
+            return self.get_gray()
+
+        return self.__get(('pyramid', level), lambda: self.__compute_pyramid(level))
+
+    def __compute_pyramid(self, level):
+        src = self.get_pyramid(level - 1)
+
+        rows, cols = src.shape
+        dst = self.__buffer(((rows + 1) / 2, (cols + 1) / 2))
+        cv2.pyrDown(src, dst)
+        return dst
+
+    def get_thumbnail(self, width):
+        '''
+        Returns:
+            the gray image shrunk to the width, keeping the aspect ratio
+        '''
+        return self.__get(('thumbnail', width), lambda: self.__compute_thumbnail(width))
+
+    def __compute_thumbnail(self, width):
+        rows, cols, _ = self.img.shape
+        height = max(1, rows * width / cols)
+
+        color = buffer_pool.get((height, width, 3))
+        cv2.resize(self.img, (width, height), color, interpolation=cv2.INTER_AREA)
+
+        thumb = self.__buffer((height, width))
+        cv2.cvtColor(color, cv2.COLOR_BGR2GRAY, thumb)
+
+        buffer_pool.release(color)
+        return thumb
+
+    def get_roi(self, roi=CENTER_ROI):
+        '''
+        Args:
+            roi: a tuple of fractions (top, bottom, left, right)
+
+        Returns:
+            a view of the region of the image
+        '''
+        rows, cols, _ = self.img.shape
+        top, bottom, left, right = roi
+        return self.img[int(rows*top):int(rows*bottom), int(cols*left):int(cols*right), :]
+
+    def get_roi_mean(self, roi=CENTER_ROI):
+        '''
+        Returns:
+            float, the mean over all channels of the region
+        '''
+        return self.__get(('roi_mean', roi), lambda: self.__compute_roi_mean(roi))
+
+    def __compute_roi_mean(self, roi):
+        img = self.get_roi(roi)
+        channels = img.shape[2]
+        return sum(cv2.mean(img)[:channels]) / channels
+
+    def get_histogram(self, roi=CENTER_ROI, step=1):
+        '''
+        Args:
+            roi: a tuple of fractions (top, bottom, left, right)
+            step: int, subsample every step-th row and column
+
+        Returns:
+            numpy array of shape (channels, 256), the histogram of each channel of the region
+        '''
+        return self.__get(('histogram', roi, step), lambda: self.__compute_histogram(roi, step))
+
+    def __compute_histogram(self, roi, step):
+        img = self.get_roi(roi)[::step, ::step, :]
+        channels = img.shape[2]
+
+        hist = self.__buffer((channels, 256), np.float32)
+        for c in range(channels):
+            hist[c, :] = cv2.calcHist([img], [c], None, [256], [0, 256])[:, 0]
+
+        return hist
+
+    def get_sharpness(self, roi=CENTER_ROI, level=1):
+        '''
+        Args:
+            roi: a tuple of fractions (top, bottom, left, right)
+            level: int, the pyramid level to be measured on
+
+        Returns:
+            float, the variance of the Laplacian of the region, larger if sharper
+        '''
+        return self.__get(('sharpness', roi, level), lambda: self.__compute_sharpness(roi, level))
+
+    def __compute_sharpness(self, roi, level):
+        gray = self.get_pyramid(level)
+        rows, cols = gray.shape
+        top, bottom, left, right = roi
+        gray = gray[int(rows*top):int(rows*bottom), int(cols*left):int(cols*right)]
+
+        laplacian = buffer_pool.get(gray.shape, np.int16)
+        cv2.Laplacian(gray, cv2.CV_16S, laplacian)
+        std = cv2.meanStdDev(laplacian)[1][0, 0]
+        buffer_pool.release(laplacian)
+
+        return std * std
+
+    def acquire(self):
+        '''
+        Take a reference, keeping the products and their buffers until release() is called.
+        '''
+        with self.lock:
+            self.refs += 1
+
+    def release(self):
+        '''
+        Drop a reference. The last one returns the buffers of the products to the pool.
+        The capture thread drops its reference when recycling the frame.
+        '''
+        with self.lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            for buf in self.buffers:
+                buffer_pool.release(buf)
+            self.buffers = []
+            self.cache = {}
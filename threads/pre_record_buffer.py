@@ -0,0 +1,119 @@
+import numpy as np
+import cv2, time, threading, collections
+
+
+
+class PreRecordBuffer(object):
+    '''
+    Keeps the most recent frames in RAM as JPEG data, so a recording can start with the past few seconds.
+
+    Each entry holds the images of all streams taken at the same time, and optional metadata.
+    The oldest entries are dropped when they are older than the time span,
+        or when the total size exceeds the memory budget.
+
+    While draining, i.e. while a recording catches up with the buffered frames,
+        entries are no longer dropped for their age, and those dropped for the budget are counted as lost.
+    '''
+
+    def __init__(self, seconds, max_bytes, jpeg_quality):
+        '''
+        Args:
+            seconds: float, the time span to be kept
+            max_bytes: int, the memory budget for the compressed images
+            jpeg_quality: int, 0..100
+        '''
+        super(PreRecordBuffer, self).__init__()
+
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.jpeg_quality = jpeg_quality
+
+        self.entries = collections.deque() # (timestamp, {stream name: JPEG data}, metadata)
+        self.n_bytes = 0
+        self.draining = False
+        self.dropped = 0 # Number of entries lost while draining
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, images, meta=None):
+        '''
+        Compress and append the images.
+
+        Args:
+            timestamp: float, time.time() when the images were taken
+            images: a dictionary {stream name: numpy image}
+            meta: a dictionary of metadata, or None
+        '''
+        data = {}
+        for name, img in images.items():
+            ret, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ret:
+                return
+            data[name] = buf
+
+        n_bytes = sum(buf.nbytes for buf in data.values())
+
+        with self.lock:
+            self.entries.append((timestamp, data, meta))
+            self.n_bytes += n_bytes
+
+            while self.entries:
+                t, data, meta = self.entries[0]
+                expired = (not self.draining) and (timestamp - t > self.seconds)
+                if not expired and self.n_bytes <= self.max_bytes:
+                    break
+
+                self.entries.popleft()
+                self.n_bytes -= sum(buf.nbytes for buf in data.values())
+                if self.draining:
+                    self.dropped += 1
+
+    def pop(self):
+        '''
+        Returns:
+            a tuple (timestamp, {stream name: numpy image}, metadata) of the oldest entry,
+                or None if the buffer is empty
+        '''
+        with self.lock:
+            if not self.entries:
+                return None
+            t, data, meta = self.entries.popleft()
+            self.n_bytes -= sum(buf.nbytes for buf in data.values())
+
+        images = dict((name, cv2.imdecode(buf, cv2.IMREAD_COLOR)) for name, buf in data.items())
+
+        return t, images, meta
+
+    def set_draining(self, draining):
+        with self.lock:
+            self.draining = draining
+            self.dropped = 0
+
+    def is_draining(self):
+        return self.draining
+
+    def get_dropped(self):
+        return self.dropped
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def is_empty(self):
+        return len(self.entries) == 0
+
+    def get_count(self):
+        return len(self.entries)
+
+    def get_seconds(self):
+        '''
+        Returns:
+            the time span of the buffered frames
+        '''
+        with self.lock:
+            if not self.entries:
+                return 0.0
+            return self.entries[-1][0] - self.entries[0][0]
+
+    def get_bytes(self):
+        return self.n_bytes
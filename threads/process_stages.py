@@ -0,0 +1,475 @@
+import numpy as np
+import cv2, time, sys, abc
+from worker_pool import *
+from buffer_pool import buffer_pool
+from stereo import Stereo as stereo
+
+
+
+class Stage(object):
+    '''
+    A step of the image processing pipeline in the ProcessThread.
+
+    Each stage declares the names of the buffers it reads (inputs) and writes (outputs),
+        and the shapes of the buffers it needs preallocated.
+    The buffers are allocated once per display size by the StageGraph,
+        so running a stage never allocates frame-sized arrays.
+
+    Subclasses define the class attributes name, inputs, outputs and the method run().
+    Stages only meaningful for a stereo pair set stereo_only, so they are skipped in the mono mode.
+    '''
+
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+    inputs = []
+    outputs = []
+    stereo_only = False
+
+    def __init__(self, enabled=True):
+        super(Stage, self).__init__()
+
+        self.enabled = enabled
+        self.t_avg = 0 # Average running time in seconds
+
+    def get_buffer_shapes(self, rows, cols):
+        '''
+        Args:
+            rows, cols: int, the dimension of the display image
+
+        Returns:
+            a dictionary of the buffers to be preallocated
+                key: str, buffer name
+                value: a tuple (shape, dtype)
+        '''
+        return {}
+
+    @abc.abstractmethod
+    def run(self, proc, config, buffers):
+        '''
+        Args:
+            proc: the ProcessThread object
+            config: the PipelineConfig of the frame, providing the processing parameters
+            buffers: a dictionary of the buffers, by name
+        '''
+        pass
+
+    def update_timing(self, dt):
+        # Exponential moving average
+        self.t_avg = 0.9 * self.t_avg + 0.1 * dt
+
+    def close(self):
+        pass
+
+
+
+class StageGraph(object):
+    '''
+    Runs the enabled stages in order and times each of them.
+
+    Stages can be enabled or disabled at any time, also from other threads, without pausing the pipeline.
+    The stage list is replaced as a whole when a stage is added (copy-on-write),
+        so the running thread always iterates over a consistent list.
+
+    In the mono mode the right and left inputs are the same stream,
+        so it is processed only once and stereo-only stages are skipped.
+    '''
+
+    def __init__(self, stages):
+        super(StageGraph, self).__init__()
+
+        self.stages = list(stages)
+        self.buffers = {}
+        self.rows, self.cols = 0, 0
+        self.mono = False
+
+    def allocate(self, rows, cols):
+        '''
+        Preallocate the buffers of all stages, including the disabled ones,
+            so enabling a stage never requires allocation.
+        Called once per display size.
+        '''
+        self.rows, self.cols = rows, cols
+
+        for stage in self.stages:
+            self.__allocate_stage(stage)
+
+    def __allocate_stage(self, stage):
+
+        for name, (shape, dtype) in stage.get_buffer_shapes(self.rows, self.cols).items():
+            buf = self.buffers.get(name, None)
+            if buf is None or buf.shape != shape or buf.dtype != dtype:
+                buffer_pool.release(buf)
+                buf = buffer_pool.get(shape, dtype)
+                buf[...] = 0
+                self.buffers[name] = buf
+
+    def run(self, proc, config):
+
+        for stage in self.stages:
+            if not self.is_active(stage):
+                continue
+
+            t0 = time.time()
+            stage.run(proc, config, self.buffers)
+            stage.update_timing(time.time() - t0)
+
+    def add_stage(self, stage, before=None):
+        '''
+        Insert a new stage before the stage named 'before', or append it if before is None.
+        '''
+        self.__allocate_stage(stage)
+
+        stages = list(self.stages)
+        if before is None:
+            stages.append(stage)
+        else:
+            stages.insert(stages.index(self.get_stage(before)), stage)
+
+        self.stages = stages
+
+    def get_stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def set_enabled(self, name, enabled):
+        self.get_stage(name).enabled = enabled
+
+    def is_enabled(self, name):
+        return self.get_stage(name).enabled
+
+    def set_mono(self, mono):
+        self.mono = mono
+
+    def is_mono(self):
+        return self.mono
+
+    def is_active(self, stage):
+        '''
+        Returns:
+            True if the stage is enabled and not skipped by the mono mode
+        '''
+        return stage.enabled and not (self.mono and stage.stereo_only)
+
+    def is_consumed(self, buffer_name):
+        '''
+        Returns:
+            True if any enabled stage reads the buffer
+        '''
+        for stage in self.stages:
+            if self.is_active(stage) and buffer_name in stage.inputs:
+                return True
+        return False
+
+    def is_produced(self, buffer_name):
+        '''
+        Returns:
+            True if any enabled stage writes the buffer
+        '''
+        for stage in self.stages:
+            if self.is_active(stage) and buffer_name in stage.outputs:
+                return True
+        return False
+
+    def get_timing_text(self):
+        texts = []
+        for stage in self.stages:
+            if self.is_active(stage):
+                texts.append('{} {:.1f} ms'.format(stage.name, stage.t_avg * 1000))
+        return ', '.join(texts)
+
+    def close(self):
+        for stage in self.stages:
+            stage.close()
+
+
+
+class WarpStage(Stage):
+    '''
+    (1) Eliminate offset of the left image.
+    (2) Resize and translate to place each image at the center of both sides of the view.
+
+    Only the visible part of each source image is warped, see self.crop_source().
+    The left image is processed on a worker, concurrently with the right image on the calling thread.
+    In the mono mode only the right image is processed.
+    Gray images are only produced if an enabled stage consumes them.
+    '''
+
+    name = 'warp'
+    inputs = ['imgR_0', 'imgL_0']
+    outputs = ['imgR_1', 'imgL_1', 'grayR_1', 'grayL_1', 'imgR_proc', 'imgL_proc']
+
+    def __init__(self, enabled=True):
+        super(WarpStage, self).__init__(enabled)
+
+        self.pool = WorkerPool(1)
+
+    def get_buffer_shapes(self, rows, cols):
+        return {'imgR_1'   : ((rows, cols/2, 3), np.uint8),
+                'imgL_1'   : ((rows, cols/2, 3), np.uint8),
+                'grayR_1'  : ((rows, cols/2   ), np.uint8),
+                'grayL_1'  : ((rows, cols/2   ), np.uint8),
+                'imgR_proc': ((rows, cols/2, 3), np.uint8),
+                'imgL_proc': ((rows, cols/2, 3), np.uint8)}
+
+    def run(self, proc, config, buffers):
+
+        if proc.graph.is_consumed('grayR_1'):
+            grayR, grayL = buffers['grayR_1'], buffers['grayL_1']
+        else:
+            grayR, grayL = None, None
+
+        interpolation = proc.quality.get_interpolation()
+
+        # The single stream is duplicated at composition
+        if proc.graph.is_mono():
+            self.process_eye(buffers['imgR_0'], config.resize_matrix_R, buffers['imgR_1'], grayR, interpolation)
+            buffers['imgR_proc'][:,:,:] = buffers['imgR_1']
+            return
+
+        job = self.pool.submit(self.process_eye, buffers['imgL_0'], config.resize_matrix_L, buffers['imgL_1'], grayL, interpolation)
+        self.process_eye(buffers['imgR_0'], config.resize_matrix_R, buffers['imgR_1'], grayR, interpolation)
+        job.wait()
+
+        # Update processed images for external access
+        buffers['imgR_proc'][:,:,:] = buffers['imgR_1']
+        buffers['imgL_proc'][:,:,:] = buffers['imgL_1']
+
+    def process_eye(self, img, matrix, dst, gray=None, interpolation=cv2.INTER_LINEAR):
+        '''
+        The per-eye work, writing into preallocated buffers.
+        OpenCV releases the GIL, so the two eyes are processed truly in parallel.
+
+        Args:
+            img: the source image
+            matrix: the resize matrix of the eye
+            dst: the output image, of the size of half of the display
+            gray: the output gray image, or None if not needed
+            interpolation: cv2.INTER_LINEAR, or cv2.INTER_NEAREST for reduced quality
+        '''
+        rows, cols, _ = dst.shape
+
+        # The area filter is skipped along with bilinear interpolation
+        area = interpolation != cv2.INTER_NEAREST
+
+        src, matrix, tmp = self.crop_source(img, matrix, rows, cols, area)
+        cv2.warpAffine(src, matrix, (cols, rows), dst=dst, flags=interpolation)
+        buffer_pool.release(tmp)
+
+        if not gray is None:
+            cv2.cvtColor(dst, cv2.COLOR_BGR2GRAY, dst=gray)
+
+    def crop_source(self, img, matrix, rows, cols, area=True):
+        '''
+        Only the part of the source image visible in the output is processed.
+
+        When zoomed in, the visible part is cropped out as a view, and the matrix is shifted accordingly.
+        When scaled down, the visible part is first shrunk once with an area filter,
+            which is sharper than the bilinear sampling of warpAffine,
+            and the remaining matrix is close to a pure translation.
+
+        Args:
+            img: the source image
+            matrix: the resize matrix, which only scales and translates
+            rows, cols: int, the dimension of the output image
+            area: boolean, whether to shrink with the area filter when scaled down
+
+        Returns:
+            a tuple (src, matrix, tmp)
+                src: the image to be warped
+                matrix: the matrix for warping src into the output
+                tmp: a buffer from the pool to be released after warping, or None
+        '''
+        img_h, img_w = img.shape[:2]
+        sx, tx = float(matrix[0, 0]), float(matrix[0, 2])
+        sy, ty = float(matrix[1, 1]), float(matrix[1, 2])
+
+        # The visible source rectangle, with a margin for interpolation
+        x0 = max(0    , int(np.floor(      -tx / sx)) - 1)
+        x1 = min(img_w, int(np.ceil ((cols - tx) / sx)) + 2)
+        y0 = max(0    , int(np.floor(      -ty / sy)) - 1)
+        y1 = min(img_h, int(np.ceil ((rows - ty) / sy)) + 2)
+
+        # Nothing visible, leave it to warpAffine to fill the border
+        if x1 <= x0 or y1 <= y0:
+            return img, matrix, None
+
+        src = img[y0:y1, x0:x1]
+        tx, ty = tx + sx * x0, ty + sy * y0
+
+        if (sx >= 1.0 and sy >= 1.0) or not area:
+            return src, np.float32([ [sx, 0 , tx] ,
+                                     [0 , sy, ty] ]), None
+
+        w = max(1, int(round((x1 - x0) * sx)))
+        h = max(1, int(round((y1 - y0) * sy)))
+        tmp = buffer_pool.get((h, w, 3))
+        cv2.resize(src, (w, h), tmp, interpolation=cv2.INTER_AREA)
+
+        # The remaining scale factor of the shrunk image, close to 1,
+        #     and the half-pixel shift between the pixel centers of src and the shrunk image
+        fx = sx * (x1 - x0) / w
+        fy = sy * (y1 - y0) / h
+        tx += 0.5 * (fx - sx)
+        ty += 0.5 * (fy - sy)
+
+        return tmp, np.float32([ [fx, 0 , tx] ,
+                                 [0 , fy, ty] ]), tmp
+
+    def close(self):
+        self.pool.close()
+
+
+
+class DepthStage(Stage):
+    '''
+    Compute stereo depth map, which replaces the left image.
+
+    Under reduced quality the depth map is computed at half resolution, with half the disparity range,
+        and scaled back up.
+    '''
+
+    name = 'depth'
+    inputs = ['imgR_1', 'imgL_1', 'grayR_1', 'grayL_1']
+    outputs = ['imgL_1', 'disparity', 'depth_map']
+    stereo_only = True
+
+    def get_buffer_shapes(self, rows, cols):
+        return {'disparity'     : ((rows  , cols/2   ), np.int16),
+                'depth_map'     : ((rows  , cols/2   ), np.uint8),
+                'grayR_half'    : ((rows/2, cols/4   ), np.uint8),
+                'grayL_half'    : ((rows/2, cols/4   ), np.uint8),
+                'disparity_half': ((rows/2, cols/4   ), np.int16),
+                'depth_map_half': ((rows/2, cols/4   ), np.uint8),
+                'imgL_half'     : ((rows/2, cols/4, 3), np.uint8)}
+
+    def run(self, proc, config, buffers):
+
+        if proc.quality.get_depth_scale() < 1.0:
+            self.run_half(proc, config, buffers)
+            return
+
+        stereo.compute_depth(buffers['imgR_1'], buffers['imgL_1'], config.ndisparities, config.SADWindowSize,
+                             grayR=buffers['grayR_1'], grayL=buffers['grayL_1'],
+                             disparity=buffers['disparity'], depth_map=buffers['depth_map'])
+
+    def run_half(self, proc, config, buffers):
+
+        grayR, grayL = buffers['grayR_half'], buffers['grayL_half']
+        rows, cols = grayR.shape
+
+        cv2.resize(buffers['grayR_1'], (cols, rows), grayR, interpolation=cv2.INTER_AREA)
+        cv2.resize(buffers['grayL_1'], (cols, rows), grayL, interpolation=cv2.INTER_AREA)
+
+        # Must be divisible by 16, and odd within 5..255
+        ndisparities = max(16, config.ndisparities / 32 * 16)
+        SADWindowSize = max(5, (config.SADWindowSize / 2) | 1)
+
+        stereo.compute_depth(buffers['imgR_1'], buffers['imgL_half'], ndisparities, SADWindowSize,
+                             grayR=grayR, grayL=grayL,
+                             disparity=buffers['disparity_half'], depth_map=buffers['depth_map_half'])
+
+        rows, cols, _ = buffers['imgL_1'].shape
+        cv2.resize(buffers['imgL_half'], (cols, rows), buffers['imgL_1'], interpolation=cv2.INTER_LINEAR)
+
+
+
+class ColorMatchStage(Stage):
+    '''
+    Match the colors and tones of the left image to the right image, with a lookup table per channel.
+
+    The tables are updated at a low rate by histogram matching of the captured frames,
+        using the histograms cached in the frames, and blended into the previous tables.
+    The tables are applied by the compose stage, which copies the left image through them at no extra cost.
+    '''
+
+    name = 'color_match'
+    inputs = []
+    outputs = ['lut_L']
+    stereo_only = True
+
+    def __init__(self, enabled=True, interval=0.5, alpha=0.3, step=4):
+        '''
+        Args:
+            interval: float, seconds between updates of the tables
+            alpha: float, weight of the new tables when blending into the previous ones
+            step: int, subsample every step-th row and column for the histograms
+        '''
+        super(ColorMatchStage, self).__init__(enabled)
+
+        self.interval = interval
+        self.alpha = alpha
+        self.step = step
+
+        self.levels = np.arange(256, dtype=np.float32)
+
+        # Starts as the identity
+        self.table = np.tile(self.levels[:, np.newaxis], (1, 3)) # float, (256 levels, 3 channels)
+        self.lut = np.zeros((1, 256, 3), np.uint8) # For cv2.LUT()
+        self.lut[0, :, :] = self.table
+
+        self.t_update = 0
+
+    def run(self, proc, config, buffers):
+
+        buffers['lut_L'] = self.lut
+
+        now = time.time()
+        if now - self.t_update < self.interval:
+            return
+        self.t_update = now
+
+        with config.cap_thread_R.get_frame() as frame_R, config.cap_thread_L.get_frame() as frame_L:
+            hist_R = frame_R.get_histogram(step = self.step)
+            hist_L = frame_L.get_histogram(step = self.step)
+
+            for c in range(3):
+                cdf_R = np.cumsum(hist_R[c]) / max(hist_R[c].sum(), 1.0)
+                cdf_L = np.cumsum(hist_L[c]) / max(hist_L[c].sum(), 1.0)
+
+                # Each level of the left image maps to the level of the right image at the same quantile
+                matched = np.interp(cdf_L, cdf_R, self.levels)
+
+                self.table[:, c] = (1 - self.alpha) * self.table[:, c] + self.alpha * matched
+
+        # Round to uint8
+        self.lut[0, :, :] = np.clip(self.table + 0.5, 0, 255)
+
+
+
+class ComposeStage(Stage):
+    '''
+    (3) Combine images side by side.
+        In the mono mode, the right image is shown on both sides.
+        If the left image is color matched, it is copied through the lookup tables.
+    '''
+
+    name = 'compose'
+    inputs = ['imgR_1', 'imgL_1', 'lut_L']
+    outputs = ['img_display']
+
+    def get_buffer_shapes(self, rows, cols):
+        return {'img_display': ((rows, cols, 3), np.uint8)}
+
+    def run(self, proc, config, buffers):
+        img_display = buffers['img_display']
+        w = img_display.shape[1]
+
+        graph = proc.graph
+
+        # Only published once the color matching stage has run,
+        #     which could be after it is enabled in the middle of a frame
+        lut_L = buffers.get('lut_L', None)
+
+        if graph.is_mono():
+            img_display[:, 0:(w/2), :] = buffers['imgR_1']
+
+        # No color matching of the depth map
+        elif graph.is_produced('lut_L') and not lut_L is None and not graph.is_produced('depth_map'):
+            cv2.LUT(buffers['imgL_1'], lut_L, img_display[:, 0:(w/2), :])
+
+        else:
+            img_display[:, 0:(w/2), :] = buffers['imgL_1']
+        img_display[:, (w/2):w, :] = buffers['imgR_1']
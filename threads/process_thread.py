@@ -1,76 +1,149 @@
 import numpy as np
-import cv2, time, sys, threading, json
+import cv2, time, sys, threading, json, multiprocessing, collections
 from constants import *
 from abstract_thread import *
-from stereo import Stereo as stereo
+from process_stages import *
+from quality_controller import *
+from buffer_pool import buffer_pool
+
+
+
+# An immutable snapshot of all parameters of the image processing pipeline.
+# It is replaced as a whole whenever any parameter changes,
+#     so each frame is rendered with one consistent set of parameters.
+PipelineConfig = collections.namedtuple('PipelineConfig', ['cap_thread_R'   , # The active capture threads
+                                                           'cap_thread_L'   ,
+                                                           'display_width'  , # The dimension of the display image
+                                                           'display_height' ,
+                                                           'zoom'           ,
+                                                           'offset_x'       , # Offset of the left image, in source pixels
+                                                           'offset_y'       ,
+                                                           'ndisparities'   , # Parameters for stereo depth map
+                                                           'SADWindowSize'  ,
+                                                           'full_source'    , # Request the largest sensor mode, e.g. for native recording
+                                                           'img_shape'      , # The source dimension the matrices are computed for
+                                                           'resize_matrix_R', # The transformation matrices
+                                                           'resize_matrix_L'])
+
 
 
 class ProcessThread(AbstractThread):
+    '''
+    All parameters of the pipeline are held in self.config, an immutable PipelineConfig.
+    Public methods change parameters by swapping in a new config (copy-on-write), from any thread,
+        without pausing this thread. The main loop takes one snapshot of the config per frame.
+    '''
 
     def __init__(self, cap_thread_R, cap_thread_L, mediator):
         super(ProcessThread, self).__init__()
 
-        self.cap_thread_R = cap_thread_R
-        self.cap_thread_L = cap_thread_L
         self.mediator = mediator
 
-        self.__init__parms()
+        # The warp stage processes the two halves in parallel.
+        # Both halves use OpenCV's internal threads, so give each half only its share of the cores.
+        cv2.setNumThreads(max(1, multiprocessing.cpu_count() / 2))
+
+        # The pipeline, in the order of execution
+        self.graph = StageGraph([WarpStage()                     ,
+                                 DepthStage(enabled = False)     ,
+                                 ColorMatchStage(enabled = False),
+                                 ComposeStage()                  ])
+
+        # Serializes the writers of self.config. The reader (main loop) needs no lock.
+        self.config_lock = threading.Lock()
+
+        self.__init__parms(cap_thread_R, cap_thread_L)
         self.set_fps(30.0)
 
-        self.connect_signals(mediator, ['display_image', 'set_info_text'])
+        # Sheds optional work when the frame rate can't be held
+        self.quality = QualityController(target_fps = self.fps)
 
-    def __init__parms(self):
-        # Parameters for image processing
-        self.offset_x, self.offset_y = 0, 0
+        self.connect_signals(mediator, ['display_image', 'set_info_text', 'set_quality_level'])
 
-        self.zoom = 1.0
+    def __init__parms(self, cap_thread_R, cap_thread_L):
 
         with open('parameters/gui.json', 'r') as fh:
             gui_parms = json.loads(fh.read())
         w = gui_parms['default_width']
         h = gui_parms['default_height']
-        self.set_display_size(w, h)
 
-        self.set_resize_matrix()
+        config = PipelineConfig(cap_thread_R    = cap_thread_R,
+                                cap_thread_L    = cap_thread_L,
+                                display_width   = w,
+                                display_height  = h,
+                                zoom            = 1.0,
+                                offset_x        = 0,
+                                offset_y        = 0,
+                                ndisparities    = 32, # Must be divisible by 16
+                                SADWindowSize   = 31, # Must be odd, be within 5..255 and be not larger than image width or height
+                                full_source     = False,
+                                img_shape       = None,
+                                resize_matrix_R = None,
+                                resize_matrix_L = None)
 
+        self.config = self.__with_resize_matrix(config)
 
+        # Preallocate the buffers of the stages, among which:
+        #     'imgR_proc'   --- processed R image to be accessed externally
+        #     'imgL_proc'   ---           L image
+        #     'img_display' --- display image to be emitted to the GUI object
+        # Reallocated by the main loop when the display size changes
+        self.graph.allocate(rows=h, cols=w)
 
-        # Parameters for stereo depth map
-        self.ndisparities = 32 # Must be divisible by 16
-        self.SADWindowSize = 31 # Must be odd, be within 5..255 and be not larger than image width or height
+        self.negotiate_source_size(self.config)
 
 
 
         # Parameters for control and timing
-        self.computingDepth = False
         self.t_series = [time.time() for i in range(30)]
+        self.n_frames = 0
 
-    def set_display_size(self, width, height):
+    def update_config(self, **changes):
         '''
-        Define the dimension of self.img_display, which is the terminal image to be displayed in the GUI.
+        Replace self.config with a copy having the changed parameters,
+            and the transformation matrices recomputed accordingly.
+        The main loop picks up the new config with the next frame, never in the middle of one.
+
+        Args:
+            changes: the PipelineConfig fields to be changed
+
+        Returns:
+            the new PipelineConfig
         '''
+        # Keep the source dimension the offset is in units of.
+        # Only the main loop changes it, along with rescaling the offset, see self.__update_source_shape().
+        # Except when switching cameras, whose image is taken as it is.
+        with self.config_lock:
+            img_shape = self.config.img_shape
+            if 'cap_thread_R' in changes or 'cap_thread_L' in changes:
+                img_shape = None
 
-        self.display_width = width
-        self.display_height = height
+            config = self.__with_resize_matrix(self.config._replace(**changes), img_shape)
+            # Assigning a reference is atomic
+            self.config = config
 
-        # Define the dimensions of:
-        #     self.imgR_proc  --- processed R image to be accessed externally
-        #     self.imgL_proc  ---           L image
-        #     self.img_display --- display image to be emitted to the GUI object
-        rows, cols = height, width
-        self.imgR_proc   = np.zeros((rows, cols/2, 3), np.uint8)
-        self.imgL_proc   = np.zeros((rows, cols/2, 3), np.uint8)
-        self.img_display = np.zeros((rows, cols  , 3), np.uint8)
+        return config
 
-    def set_resize_matrix(self):
+    def get_config(self):
+        return self.config
+
+    def __with_resize_matrix(self, config, img_shape=None):
         '''
         Define the transformation matrix for the image processing pipeline.
+
+        Args:
+            config: PipelineConfig
+            img_shape: the dimension of the source image, or None to take it from the current image
+
+        Returns:
+            a copy of config with the img_shape and the matrices
         '''
 
-        img = self.cap_thread_R.get_image()
-        img_height, img_width, _ = img.shape
+        if img_shape is None:
+            img_shape = config.cap_thread_R.get_image().shape
+        img_height, img_width, _ = img_shape
 
-        display_height, display_width = self.display_height, self.display_width
+        display_height, display_width = config.display_height, config.display_width
 
         # The height-to-width ratio
         ratio_img = float(img_height) / img_width
@@ -84,8 +157,8 @@ class ProcessThread(AbstractThread):
             base_scale = float(display_width/2) / img_width # Width is the limiting factor
 
         # The actual scale factor is the product of the base scale factor and the zoom factor.
-        scale_x = base_scale * self.zoom
-        scale_y = base_scale * self.zoom
+        scale_x = base_scale * config.zoom
+        scale_y = base_scale * config.zoom
 
 
 
@@ -102,16 +175,63 @@ class ProcessThread(AbstractThread):
         Sx = scale_x
         Sy = scale_y
 
-        Off_x = self.offset_x
-        Off_y = self.offset_y
+        Off_x = config.offset_x
+        Off_y = config.offset_y
 
         # For the right image, it's only scaling and centering
-        self.resize_matrix_R = np.float32([ [Sx, 0 , tx] ,
-                                            [0 , Sy, ty] ])
+        resize_matrix_R = np.float32([ [Sx, 0 , tx] ,
+                                       [0 , Sy, ty] ])
 
         # For the left image, in addition to scaling and centering, the offset is also applied.
-        self.resize_matrix_L = np.float32([ [Sx, 0 , Sx*Off_x + tx] ,
-                                            [0 , Sy, Sy*Off_y + ty] ])
+        resize_matrix_L = np.float32([ [Sx, 0 , Sx*Off_x + tx] ,
+                                       [0 , Sy, Sy*Off_y + ty] ])
+
+        return config._replace(img_shape       = img_shape      ,
+                               resize_matrix_R = resize_matrix_R,
+                               resize_matrix_L = resize_matrix_L)
+
+    def __update_source_shape(self, config, img_shape):
+        '''
+        Recompute the matrices for a new source dimension.
+        The offset is in pixels of the source image, so scale it along.
+
+        Returns:
+            the new PipelineConfig, or None if the config has been replaced in the meantime
+        '''
+        with self.config_lock:
+            if not self.config is config:
+                return None
+
+            ratio = float(img_shape[1]) / config.img_shape[1]
+            config = config._replace(offset_x = config.offset_x * ratio,
+                                     offset_y = config.offset_y * ratio)
+
+            config = self.__with_resize_matrix(config, img_shape)
+            self.config = config
+
+        return config
+
+    def negotiate_source_size(self, config):
+        '''
+        Request from the capture threads the smallest source image that still fills
+            the display at the current zoom level without upscaling.
+        If config.full_source is set, request the largest source image instead.
+        '''
+        img = config.cap_thread_R.get_image()
+        img_height, img_width, _ = img.shape
+
+        # The same scale factor as in self.__with_resize_matrix()
+        scale = min( float(config.display_height) / img_height ,
+                     float(config.display_width/2) / img_width ) * config.zoom
+
+        width, height = int(img_width * scale), int(img_height * scale)
+
+        # No sensor mode satisfies it, so the largest one is selected
+        if config.full_source:
+            width, height = float('inf'), float('inf')
+
+        for thread in set([config.cap_thread_R, config.cap_thread_L]):
+            thread.request_source_size(width, height)
 
     def main(self):
         '''
@@ -119,15 +239,21 @@ class ProcessThread(AbstractThread):
         with some additional steps in between.
 
         ( ) Check image dimensions.
-        (1) Eliminate offset of the left image.
-        (2) Resize and translate to place each image at the center of both sides of the view.
-        ( ) Compute depth map (optional).
-        (3) Combine images.
+        (1) Eliminate offset of the left image.                                        -- 'warp' stage
+        (2) Resize and translate to place each image at the center of both sides of the view. -- 'warp' stage
+        ( ) Compute depth map (optional).                                              -- 'depth' stage
+        ( ) Update color matching tables (optional).                                   -- 'color_match' stage
+        (3) Combine images.                                                            -- 'compose' stage
         '''
 
+        t0 = time.time()
+
+        # One consistent snapshot of the parameters for the whole frame
+        config = self.config
+
         # Get the images from self.capture_thread
-        self.imgR_0 = self.cap_thread_R.get_image() # The suffix '_0' means raw input image
-        self.imgL_0 = self.cap_thread_L.get_image()
+        self.imgR_0 = config.cap_thread_R.get_image() # The suffix '_0' means raw input image
+        self.imgL_0 = config.cap_thread_L.get_image()
 
         # Quick check on the image dimensions
         # If not matching, skip all following steps
@@ -137,38 +263,41 @@ class ProcessThread(AbstractThread):
             time.sleep(0.1)
             return
 
-        # (1) Eliminate offset of the left image.
-        # (2) Resize and translate to place each image at the center of both sides of the view.
-        rows, cols = self.display_height, self.display_width / 2 # Output image dimension
+        # The source dimension changes when a camera is attached after start-up,
+        #     or when the camera switches to another sensor mode
+        if not self.imgR_0.shape == config.img_shape:
+            config = self.__update_source_shape(config, self.imgR_0.shape)
+            # Try again with the next frame if the parameters were changed concurrently
+            if config is None:
+                return
+            # The crops and frame products of the previous source shape are not needed again
+            buffer_pool.clear()
 
-        self.imgR_1 = cv2.warpAffine(self.imgR_0, self.resize_matrix_R, (cols, rows))
-        self.imgL_1 = cv2.warpAffine(self.imgL_0, self.resize_matrix_L, (cols, rows))
+        # The display size has changed
+        if (self.graph.rows, self.graph.cols) != (config.display_height, config.display_width):
+            self.graph.allocate(rows=config.display_height, cols=config.display_width)
+            # Drop the buffers of the previous display size, just released by the stages
+            buffer_pool.clear()
 
-        # Update processed images for external access
-        self.imgR_proc[:,:,:] = self.imgR_1[:,:,:]
-        self.imgL_proc[:,:,:] = self.imgL_1[:,:,:]
+        # The same capture thread on both sides, e.g. in the AMBIENT mode
+        self.graph.set_mono(config.cap_thread_R is config.cap_thread_L)
 
-        # Compute stereo depth map (optional)
-        if self.computingDepth:
-            self.imgL_1 = self.compute_depth()
+        # Run the stages of the pipeline
+        buffers = self.graph.buffers
+        buffers['imgR_0'] = self.imgR_0
+        buffers['imgL_0'] = self.imgL_0
 
-        # (3) Combine images.
-        h, w = self.display_height, self.display_width
-        self.img_display[:, 0:(w/2), :] = self.imgL_1
-        self.img_display[:, (w/2):w, :] = self.imgR_1
+        self.graph.run(self, config)
 
         self.mediator.emit_signal( signal_name = 'display_image',
-                                   arg = self.img_display )
-
-        self.emit_fps_info()
+                                   arg = buffers['img_display'] )
 
-    def compute_depth(self):
-        imgL = stereo.compute_depth(self.imgR_1, self.imgL_1, self.ndisparities, self.SADWindowSize)
-        return imgL
+        self.emit_fps_info(busy_time = time.time() - t0)
 
-    def emit_fps_info(self):
+    def emit_fps_info(self, busy_time):
         '''
-        Emits real-time frame-rate info to the gui
+        Emits real-time frame-rate info to the gui.
+        Also updates the quality level from the frame rate and the processing time of the frame.
         '''
 
         # Shift time series by one
@@ -180,8 +309,26 @@ class ProcessThread(AbstractThread):
         # Calculate frame rate
         rate = len(self.t_series) / (self.t_series[0] - self.t_series[-1])
 
+        if self.quality.update(busy_time, rate):
+            data = {'level': self.quality.get_level(),
+                    'text': self.quality.get_text()}
+            self.mediator.emit_signal( signal_name = 'set_quality_level',
+                                       arg = data )
+
+        # Under reduced quality, the info text is refreshed less frequently
+        self.n_frames += 1
+        if self.n_frames % self.quality.get_info_interval() != 0:
+            return
+
+        text = 'Active process thread: {} fps, {} buffer allocations'.format(rate, buffer_pool.get_allocations())
         data = {'line': 3,
-                'text': 'Active process thread: {} fps'.format(rate)}
+                'text': text}
+
+        self.mediator.emit_signal( signal_name = 'set_info_text',
+                                   arg = data )
+
+        data = {'line': 7,
+                'text': 'Stages: ' + self.graph.get_timing_text()}
 
         self.mediator.emit_signal( signal_name = 'set_info_text',
                                    arg = data )
@@ -193,12 +340,9 @@ class ProcessThread(AbstractThread):
         x_limit, y_limit = 100, 100
 
         if abs(offset_x) > x_limit or abs(offset_y) > y_limit:
-            self.offset_x, self.offset_y = 0, 0
-
-        else:
-            self.offset_x, self.offset_y = offset_x, offset_y
+            offset_x, offset_y = 0, 0
 
-        self.set_resize_matrix()
+        self.update_config(offset_x=offset_x, offset_y=offset_y)
 
     def detect_offset(self):
         '''
@@ -206,46 +350,57 @@ class ProcessThread(AbstractThread):
         2) Use correlation function to calculate the offset.
         '''
 
-        imgR = self.cap_thread_R.get_image()
-        imgL = self.cap_thread_L.get_image()
+        config = self.config
 
-        imgR = cv2.cvtColor(imgR, cv2.COLOR_BGR2GRAY)
-        imgL = cv2.cvtColor(imgL, cv2.COLOR_BGR2GRAY)
+        # The gray images are shared with other threads through the frame cache
+        with config.cap_thread_R.get_frame() as frameR, config.cap_thread_L.get_frame() as frameL:
+            grayR = frameR.get_gray()
+            grayL = frameL.get_gray()
 
-        if not imgR.shape == imgL.shape:
-            return
+            if not grayR.shape == grayL.shape:
+                return
+
+            # All intermediate images are recycled through the buffer pool
+            row, col = grayR.shape
+
+            # Define ROI of the left image
+            a = int(row*0.25)
+            b = int(row*0.75)
+            c = int(col*0.25)
+            d = int(col*0.75)
+            roiL = buffer_pool.get((b-a, d-c), np.float32)
+            roiL[...] = grayL[a:b, c:d]
+
+            floatR = buffer_pool.get((row, col), np.float32)
+            floatR[...] = grayR
+
+        mat = buffer_pool.get((row-(b-a)+1, col-(d-c)+1), np.float32)
+        cv2.matchTemplate(floatR, roiL, cv2.TM_CCORR_NORMED, mat)
 
-        # Define ROI of the left image
-        row, col = imgL.shape
-        a = int(row*0.25)
-        b = int(row*0.75)
-        c = int(col*0.25)
-        d = int(col*0.75)
-        roiL = np.float32( imgL[a:b, c:d] )
+        x_max, y_max = cv2.minMaxLoc(mat)[3]
 
-        mat = cv2.matchTemplate(image  = np.float32(imgR)   ,
-                                templ  = roiL               ,
-                                method = cv2.TM_CCORR_NORMED)
+        for buf in [roiL, floatR, mat]:
+            buffer_pool.release(buf)
 
         # Vertical alignment, should always be done
-        y_max = cv2.minMaxLoc(mat)[3][1]
         offset_y = y_max - row / 4
 
         # Horizontal alignment, for infinitely far objects
-        x_max = cv2.minMaxLoc(mat)[3][0]
         offset_x = x_max - col / 4
 
         return offset_x, offset_y
 
     def zoom_in(self):
-        if self.zoom * 1.01 < 2.0:
-            self.zoom = self.zoom * 1.01
-            self.set_resize_matrix()
+        zoom = self.config.zoom
+        if zoom * 1.01 < 2.0:
+            config = self.update_config(zoom = zoom * 1.01)
+            self.negotiate_source_size(config)
 
     def zoom_out(self):
-        if self.zoom / 1.01 > 0.5:
-            self.zoom = self.zoom / 1.01
-            self.set_resize_matrix()
+        zoom = self.config.zoom
+        if zoom / 1.01 > 0.5:
+            config = self.update_config(zoom = zoom / 1.01)
+            self.negotiate_source_size(config)
 
     def apply_depth_parameters(self, parameters):
         """
@@ -254,32 +409,64 @@ class ProcessThread(AbstractThread):
                 key: str, parameter name
                 value: int, parameter value
         """
-        for key, value in parameters.items():
-            setattr(self, key, value)
+        changes = {}
+        for key in ['ndisparities', 'SADWindowSize']:
+            if key in parameters:
+                changes[key] = parameters[key]
 
-    def change_display_size(self, width, height):
-        self.pause()
+        self.update_config(**changes)
 
-        self.set_display_size(width, height)
-        self.set_resize_matrix()
+    def change_display_size(self, width, height):
+        '''
+        Define the dimension of the display image, which is the terminal image to be displayed in the GUI.
+        The buffers are reallocated by the main loop with the next frame.
+        '''
+        config = self.update_config(display_width=width, display_height=height)
+        self.negotiate_source_size(config)
 
-        self.resume()
+    def set_full_source(self, enabled):
+        '''
+        Make the capture threads deliver their largest image, regardless of the display size,
+            or go back to the smallest sufficient one.
+        '''
+        config = self.update_config(full_source=enabled)
+        self.negotiate_source_size(config)
 
     def get_processed_images(self):
-        return self.imgR_proc, self.imgL_proc
+        if self.is_mono():
+            return self.graph.buffers['imgR_proc'], self.graph.buffers['imgR_proc']
+        return self.graph.buffers['imgR_proc'], self.graph.buffers['imgL_proc']
+
+    def is_mono(self):
+        config = self.config
+        return config.cap_thread_R is config.cap_thread_L
 
     def get_display_image(self):
-        return self.img_display
+        return self.graph.buffers['img_display']
 
-    def set_cap_threads(self, thread_R, thread_L):
-        self.pause()
+    def add_stage(self, stage, before=None):
+        '''
+        Add a processing stage to the pipeline without pausing it.
 
-        self.cap_thread_R = thread_R
-        self.cap_thread_L = thread_L
+        Args:
+            stage: a Stage object
+            before: str, the name of the stage to insert before, or None to append
+        '''
+        self.graph.add_stage(stage, before)
 
-        # The input image dimension could be different after switching camera
-        # So reset resize matrix
-        self.set_resize_matrix()
+    def set_stage_enabled(self, name, enabled):
+        self.graph.set_enabled(name, enabled)
 
-        self.resume()
+    def toggle_stage(self, name):
+        self.graph.set_enabled(name, not self.graph.is_enabled(name))
+
+    def after_stopped(self):
+        self.graph.close()
+        return True
+
+    def set_cap_threads(self, thread_R, thread_L):
+        # The input image dimension could be different after switching camera
+        # So the resize matrix is recomputed along
+        config = self.update_config(cap_thread_R=thread_R, cap_thread_L=thread_L)
+        self.negotiate_source_size(config)
 
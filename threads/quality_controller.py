@@ -0,0 +1,133 @@
+import cv2, time, json
+
+
+
+class QualityController(object):
+    '''
+    Sheds optional work of the image processing pipeline to hold the target frame rate,
+        and restores it when there is headroom again.
+
+    The optional work is degraded one level at a time, in the order of self.levels.
+    Each level includes the degradations of all lower levels.
+
+    Degrading happens once the frame rate has stayed below the target for the settle time.
+    Restoring happens once the load (processing time / frame period) has stayed low for the hold time of the level,
+        which doubles whenever a restore is immediately followed by degrading again.
+    '''
+
+    levels = ['Full quality'                  ,
+              'Half-resolution depth map'     ,
+              'Less frequent alignment'       ,
+              'Nearest-neighbor interpolation',
+              'Less frequent info refresh'    ]
+
+    def __init__(self, target_fps):
+        super(QualityController, self).__init__()
+
+        self.target_fps = target_fps
+
+        self.__init__parameters()
+
+        self.level = 0
+        self.load = 0.0 # Exponential moving average of the processing time / frame period
+
+        self.state = None # 'degrade', 'restore' or None, the condition currently holding
+        self.t_state = time.time() # Since when the condition holds
+        self.t_changed = time.time() # When the level was last changed
+        self.last_change = 0 # +1 if last degraded, -1 if last restored
+
+        # The hold time before restoring from each level
+        self.hold = [self.hold_time for l in self.levels]
+
+    def __init__parameters(self):
+        '''
+        Load parameters from the parameters/quality.json file
+        '''
+        with open('parameters/quality.json', 'r') as fh:
+            parms = json.loads(fh.read())
+
+        L = ['degrade_ratio', # Degrade if frame rate < target * degrade_ratio
+             'restore_load', # Restore if load < restore_load
+             'settle_time',
+             'hold_time',
+             'max_hold_time',
+             'align_interval_factor',
+             'info_interval']
+
+        for name in L:
+            setattr(self, name, parms[name])
+
+    def update(self, busy_time, rate):
+        '''
+        Called once per frame by the ProcessThread.
+
+        Args:
+            busy_time: float, seconds spent on processing the frame
+            rate: float, the measured frame rate
+
+        Returns:
+            True if the level has changed, False otherwise
+        '''
+        self.load = 0.9 * self.load + 0.1 * busy_time * self.target_fps
+
+        now = time.time()
+
+        # Let the frame rate measurement settle after the last change
+        if now - self.t_changed < self.settle_time:
+            return False
+
+        if rate < self.target_fps * self.degrade_ratio and self.level < len(self.levels) - 1:
+            state = 'degrade'
+        elif self.load < self.restore_load and self.level > 0:
+            state = 'restore'
+        else:
+            state = None
+
+        if state != self.state:
+            self.state, self.t_state = state, now
+            return False
+
+        if state == 'degrade' and now - self.t_state > self.settle_time:
+            # The previous level could not be held right after restoring it, so wait longer next time
+            if self.last_change == -1 and now - self.t_changed < self.hold[self.level + 1]:
+                self.hold[self.level + 1] = min(2 * self.hold[self.level + 1], self.max_hold_time)
+            self.__change(+1, now)
+            return True
+
+        if state == 'restore' and now - self.t_state > self.hold[self.level]:
+            self.__change(-1, now)
+            return True
+
+        return False
+
+    def __change(self, step, now):
+        self.level += step
+        self.last_change = step
+        self.t_changed = now
+        self.state, self.t_state = None, now
+
+    def get_level(self):
+        return self.level
+
+    def get_text(self):
+        '''
+        Returns:
+            str, the description of the current level
+        '''
+        return self.levels[self.level]
+
+    def get_depth_scale(self):
+        return 0.5 if self.level >= 1 else 1.0
+
+    def get_align_interval_factor(self):
+        return self.align_interval_factor if self.level >= 2 else 1
+
+    def get_interpolation(self):
+        return cv2.INTER_NEAREST if self.level >= 3 else cv2.INTER_LINEAR
+
+    def get_info_interval(self):
+        '''
+        Returns:
+            int, emit info text every this many frames
+        '''
+        return self.info_interval if self.level >= 4 else 1
@@ -0,0 +1,92 @@
+import threading, Queue
+
+
+
+class Job(object):
+    '''
+    A task submitted to the WorkerPool. Call wait() to get the return value of the task.
+    '''
+
+    def __init__(self, func, args):
+        super(Job, self).__init__()
+
+        self.func = func
+        self.args = args
+
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as exception_inst:
+            self.exception = exception_inst
+
+        self.done.set()
+
+    def wait(self):
+        '''
+        Block until the task is done.
+
+        Returns:
+            the return value of the task. Exceptions raised by the task are raised again here.
+        '''
+        self.done.wait()
+
+        if not self.exception is None:
+            raise self.exception
+
+        return self.result
+
+
+
+class WorkerPool(object):
+    '''
+    A small pool of persistent worker threads.
+
+    Meant for OpenCV and numpy work which releases the GIL,
+        so the workers run truly in parallel with each other and with the submitting thread.
+    '''
+
+    def __init__(self, n_workers):
+        super(WorkerPool, self).__init__()
+
+        self.queue = Queue.Queue()
+
+        self.workers = []
+        for i in range(n_workers):
+            t = threading.Thread(target=self.__work)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def __work(self):
+
+        while True:
+            job = self.queue.get()
+
+            # None is the signal for terminating the worker
+            if job is None:
+                return
+
+            job.run()
+
+    def submit(self, func, *args):
+        '''
+        Returns:
+            a Job object
+        '''
+        job = Job(func, args)
+        self.queue.put(job)
+        return job
+
+    def close(self):
+        '''
+        Terminate the workers after the submitted jobs are done.
+        '''
+        for t in self.workers:
+            self.queue.put(None)
+
+        for t in self.workers:
+            t.join()
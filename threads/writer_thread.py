@@ -1,10 +1,39 @@
 import numpy as np
-import cv2, time, sys, threading, os, json
+import cv2, time, sys, threading, os, json, shutil
 from abstract_thread import *
+from capture_thread import NewFrameCounter
+from buffer_pool import buffer_pool
+from video_encoder import EncoderProcess, list_recordings, recover_recordings
+from video_backends import load_backends, rank_backends
+from pre_record_buffer import PreRecordBuffer
 
 
 
 class WriterThread(AbstractThread):
+    '''
+    Takes images at a constant frame rate, and passes them with their timestamps
+        to EncoderProcess objects, which encode them in separate processes.
+
+    The video files are encoded by the first EncoderBackend, in the order of preference,
+        which sustains the frame rate according to a probe, see video_backends.rank_backends().
+
+    Each recording is written directly into its own directory under self.recording_dir,
+        as segment files of self.segment_seconds with an index file for each stream.
+
+    Two recording modes:
+        'display' --- the display image of the process thread, into one video
+        'native'  --- the right and left camera images at sensor resolution, into one video each,
+                      plus the offset and zoom of every frame in meta.jsonl,
+                      so depth and alignment can be reprocessed offline at full quality
+
+    While not recording, the images are kept for the last few seconds in a PreRecordBuffer.
+    A recording starts with the buffered images, and live images queue up behind them
+        until the encoders have caught up, so there is no gap.
+
+    Starting a recording never blocks the gui. The cameras are switched and the encoders are opened
+        over the first iterations of the main loop, which keep buffering images meanwhile.
+    The gui is signaled by 'recording_starts' once the video files are opened.
+    '''
 
     def __init__(self, process_thread, mediator):
         super(WriterThread, self).__init__()
@@ -19,48 +48,289 @@ class WriterThread(AbstractThread):
         self.connect_signals(mediator = self.mediator,
                              signal_names = ['recording_starts',
                                              'recording_ends'  ,
-                                             'set_time_label'  ])
-
-        self.writer = None
+                                             'set_time_label'  ,
+                                             'set_info_text'   ])
+
+        # key: stream name, value: EncoderProcess
+        self.writers = {}
+        # key: stream name, value: (width, height) of the video
+        self.sizes = {}
+        # key: stream name, value: the resizing buffer
+        self.imgs_resized = {}
+
+        self.meta_file = None
+        self.n_written = 0
+
+        self.pre_buffer = PreRecordBuffer(seconds = self.pre_record_seconds,
+                                        max_bytes = self.pre_record_max_mb * 1024 * 1024,
+                                     jpeg_quality = self.pre_record_jpeg_quality)
+        self.t_buffered = 0
+
+        self.session_dir = None
+        self.backend = None
+
+        # While starting, the phase 'settling' or 'opening', otherwise None
+        self.start_phase = None
+        self.start_backends = [] # The backends left to be tried
+        self.t_phase = 0 # When the phase started, or the backend was tried
+        self.frame_counter = None # New frames of the cameras while settling
+
+        # key: (width, height), value: a list of (EncoderBackend, measured fps)
+        self.ranked_backends = {}
+        self.probe_lock = threading.Lock()
+        self.probing = set() # The sizes being probed in the background
+
+        # Only the recordings from before, never one started in the meantime
+        session_dirs = list_recordings(self.recording_dir)
+
+        # Without delaying the start-up
+        t = threading.Thread(target=self.prepare, args=(session_dirs,))
+        t.daemon = True
+        t.start()
 
     def __init__parameters(self):
 
-        self.temp_video_fname = 'temp.avi'
-
-        # Some of the available codecs on native Windows PC: 'DIB ', 'I420', 'IYUV'...
-        #     which are all uncompressive codecs
-        # The compressive X264 codec needs to be installed seperately before use
-        self.fourcc = cv2.cv.CV_FOURCC(*'X264')
-
         with open('parameters/video_writer.json') as fh:
             p = json.loads(fh.read())
 
         for name, value in p.items():
             setattr(self, name, value)
 
+        # Some of the available codecs on native Windows PC: 'DIB ', 'I420', 'IYUV'...
+        #     which are all uncompressive codecs
+        # The compressive X264 codec needs to be installed seperately before use
+        self.backends = load_backends(self.backends)
+
+    def prepare(self, session_dirs):
+        '''
+        Finalize the segments left open by a crash, and probe the encoder backends at the display video size.
+        '''
+        # The first backend which opens, in the order of preference, without waiting for the probe
+        recover_recordings(session_dirs, self.backends, self.fps)
+
+        self.get_ranked_backends()
+
+        if self.record_mode == 'native':
+            self.get_ranked_backends(self.get_native_size())
+
+    def get_ranked_backends(self, size=None):
+        '''
+        Probe the backends at the video size, once for each size.
+
+        Args:
+            size: tuple (width, height), or None for the size of the display video
+
+        Returns:
+            a list of (EncoderBackend, measured fps), the best first
+        '''
+        if size is None:
+            size = (self.img_width, self.img_height)
+
+        with self.probe_lock:
+            if not size in self.ranked_backends:
+                ranked = rank_backends(backends = self.backends    ,
+                                            fps = self.fps         ,
+                                           size = size             ,
+                                       n_frames = self.probe_frames,
+                                         margin = self.probe_margin)
+
+                self.ranked_backends[size] = ranked
+
+                text = ', '.join('{} {:.0f} fps'.format(b.get_name(), rate) for b, rate in ranked)
+                print 'Video encoders at {}x{}: {}'.format(size[0], size[1], text or 'none available')
+
+            return self.ranked_backends[size]
+
+    def probe_in_background(self, size):
+        '''
+        Probe the backends at the video size in a background thread, unless already probed or being probed.
+        '''
+        if size in self.ranked_backends or size in self.probing:
+            return
+        self.probing.add(size)
+
+        t = threading.Thread(target=self.get_ranked_backends, args=(size,))
+        t.daemon = True
+        t.start()
+
+    def select_backends(self, size):
+        '''
+        Never waits for a probe, so starting a recording does not freeze the gui.
+
+        Returns:
+            a list of EncoderBackend, the best first for the video size if probed,
+                otherwise for the display video size, or in the order of preference
+        '''
+        ranked = self.ranked_backends.get(size, None)
+
+        if ranked is None:
+            # Ready for the next recording
+            self.probe_in_background(size)
+            ranked = self.ranked_backends.get((self.img_width, self.img_height), None)
+
+        if ranked is None:
+            return list(self.backends)
+
+        return [b for b, rate in ranked]
+
+    def get_native_size(self):
+        '''
+        Returns:
+            a tuple (width, height), the larger video size of the streams in the native mode
+        '''
+        config = self.process_thread.get_config()
+        sizes = [config.cap_thread_R.get_largest_size(), config.cap_thread_L.get_largest_size()]
+        return max(sizes, key=lambda s: s[0] * s[1])
+
     def main(self):
 
-        if self.writer:
+        if not self.start_phase is None:
+            self.step_start()
+            return
+
+        if not self.writers:
+            return
+
+        t = time.time()
+        images, meta = self.take_images()
+
+        if self.pre_buffer.is_draining():
+            # Queue up behind the buffered images, which keeps the order
+            self.pre_buffer.add(t, images, meta)
+            self.drain(t_limit = t + 0.5 / self.fps)
+        else:
+            self.write_images(t, images, meta)
+
+        if not all(w.is_alive() for w in self.writers.values()):
+            self.abort_recording()
+            return
+
+        self.emit_time_label()
+        self.emit_info()
+
+    def while_paused(self):
+
+        if not self.pre_record:
+            return
+
+        # Stopped while catching up, so after_paused() is writing the rest of the buffer.
+        # Frames taken after the stop must not be added to the recording.
+        if self.pre_buffer.is_draining():
+            return
+
+        # Keep the frame rate of the recording
+        t = time.time()
+        if t - self.t_buffered < 1. / self.fps:
+            return
+        self.t_buffered = t
+
+        images, meta = self.take_images()
+        self.pre_buffer.add(t, images, meta)
+
+    def take_images(self):
+        '''
+        Returns:
+            a tuple (images, meta)
+                images: a dictionary {stream name: numpy image} for the current recording mode
+                meta: a dictionary of the offset and zoom in the native mode, None otherwise
+        '''
+        if self.record_mode == 'native':
+            config = self.process_thread.get_config()
+            images = {'R': config.cap_thread_R.get_image()}
+            if not self.process_thread.is_mono():
+                images['L'] = config.cap_thread_L.get_image()
+
+            meta = {'offset_x'    : config.offset_x    ,
+                    'offset_y'    : config.offset_y    ,
+                    'zoom'        : config.zoom        ,
+                    'source_width': config.img_shape[1]}
+        else:
             # Get the processed image from the process thread
-            img = self.process_thread.get_display_image()
-
-            # If the image does not match the pre-defined video dimension...
-            #     resize it to the correct video dimension
-            h, w, _ = img.shape
-            H, W = self.img_height, self.img_width
-            if h != H or w != W:
-
-                Sx = self.img_width / float(w) # scale_x
-                Sy = self.img_height / float(h) # scale_y
-
-                # the transformatio matrix
-                mat = np.float32([ [Sx, 0 , 0] ,
-                                   [0 , Sy, 0] ])
-
-                img = cv2.warpAffine(img, mat, (W, H))
-
-            self.writer.write(img)
-            self.emit_time_label()
+            images = {'display': self.process_thread.get_display_image()}
+            meta = None
+
+        return images, meta
+
+    def write_images(self, t, images, meta):
+        '''
+        Pass the images of one frame to the encoders, and write the metadata if any.
+
+        Returns:
+            False if an encoder did not take its image, True otherwise
+        '''
+        ok = True
+        for name, img in images.items():
+            # A stream missing from the recording, e.g. L after switching to a single camera
+            if not name in self.writers:
+                continue
+            img = self.resize(name, img)
+            if not self.writers[name].write(img, t):
+                ok = False
+
+        if not meta is None:
+            self.write_meta(t, meta)
+
+        self.n_written += 1
+
+        return ok
+
+    def drain(self, t_limit):
+        '''
+        Move the buffered images to the encoders as long as they have free slots, until t_limit.
+        '''
+        while time.time() < t_limit:
+            if min(w.get_free_slots() for w in self.writers.values()) == 0:
+                return
+
+            entry = self.pre_buffer.pop()
+            if entry is None:
+                # Caught up with the live images
+                self.pre_buffer.set_draining(False)
+                return
+
+            if not self.write_images(*entry):
+                return
+
+    def resize(self, name, img):
+        '''
+        If the image does not match the video dimension of the stream...
+            resize it to the correct video dimension.
+        '''
+        h, w, _ = img.shape
+        W, H = self.sizes[name]
+        if h == H and w == W:
+            return img
+
+        Sx = W / float(w) # scale_x
+        Sy = H / float(h) # scale_y
+
+        # the transformatio matrix
+        mat = np.float32([ [Sx, 0 , 0] ,
+                           [0 , Sy, 0] ])
+
+        # Resize into the same buffer every frame
+        if not name in self.imgs_resized:
+            self.imgs_resized[name] = buffer_pool.get((H, W, 3))
+
+        return cv2.warpAffine(img, mat, (W, H), dst=self.imgs_resized[name])
+
+    def write_meta(self, t, meta):
+        '''
+        Write one line of JSON for the frame, with the offset in pixels of the video.
+        '''
+        W, H = self.sizes['R']
+
+        # The offset is in pixels of the source image, which could differ from the video
+        ratio = float(W) / meta['source_width']
+
+        meta = {'frame'   : self.n_written              ,
+                'time'    : t                           ,
+                'offset_x': meta['offset_x'] * ratio    ,
+                'offset_y': meta['offset_y'] * ratio    ,
+                'zoom'    : meta['zoom']                }
+
+        self.meta_file.write(json.dumps(meta) + '\n')
+        self.meta_file.flush()
 
     def emit_time_label(self):
         S = int( time.clock() - self.recording_start_time )
@@ -77,46 +347,312 @@ class WriterThread(AbstractThread):
         text = '{}:{}:{}'.format(H, M, S)
         self.mediator.emit_signal('set_time_label', text)
 
+    def emit_info(self):
+
+        texts = []
+        for name in sorted(self.writers.keys()):
+            counters = self.writers[name].get_counters()
+            texts.append('{}: {} encoded, {} dropped, {} duplicated'.format(name,
+                                                                           counters['encoded'],
+                                                                           counters['dropped'],
+                                                                           counters['duplicated']))
+
+        if self.pre_buffer.is_draining():
+            texts.append('{} frames behind, {} lost'.format(self.pre_buffer.get_count(),
+                                                           self.pre_buffer.get_dropped()))
+
+        data = {'line': 9,
+                'text': 'Writer thread ({}) '.format(self.backend.get_name()) + '; '.join(texts)}
+
+        self.mediator.emit_signal( signal_name = 'set_info_text',
+                                   arg = data )
+
+    def make_session_dir(self):
+        '''
+        Returns:
+            the path of a new directory for the recording, named after the current time
+        '''
+        name = time.strftime('stereo_video_%Y%m%d_%H%M%S')
+        path = os.path.join(self.recording_dir, name)
+
+        i = 1
+        while os.path.exists(path):
+            path = os.path.join(self.recording_dir, '{}_{}'.format(name, i))
+            i += 1
+
+        os.makedirs(path)
+        return path
+
+    def get_native_sizes(self):
+        '''
+        Returns:
+            a dictionary of the video sizes of the streams in the native mode, from the current images
+        '''
+        config = self.process_thread.get_config()
+
+        sizes = {}
+        h, w, _ = config.cap_thread_R.get_image().shape
+        sizes['R'] = (w, h)
+
+        # Only one stream from a single camera
+        if not self.process_thread.is_mono():
+            h, w, _ = config.cap_thread_L.get_image().shape
+            sizes['L'] = (w, h)
+
+        return sizes
+
     def before_resuming(self):
+        '''
+        Runs on the gui thread, so the cameras and encoders are started by self.step_start() instead.
+        '''
+        if self.record_mode == 'native':
+            # Switch the cameras to their largest sensor mode, and let the new frames come in
+            self.process_thread.set_full_source(True)
+            config = self.process_thread.get_config()
+            self.frame_counter = NewFrameCounter([config.cap_thread_R, config.cap_thread_L])
+            self.start_phase = 'settling'
+        else:
+            self.sizes = {'display': (self.img_width, self.img_height)}
+            self.start_backends = None
+            self.start_phase = 'opening'
+
+        self.t_phase = time.time()
 
-        # Create VideoWriter object
-        self.writer = cv2.VideoWriter(self.temp_video_fname,
-                                      self.fourcc,
-                                      self.fps,
-                                      (self.img_width, self.img_height))
+        return True
 
-        if not self.writer.isOpened():
-            self.writer = None
+    def step_start(self):
+        '''
+        Called by each iteration of the main loop until the recording starts, never blocking for long.
+        The images are buffered meanwhile, so the recording still starts with them.
+        '''
+        t = time.time()
+        if self.pre_record:
+            images, meta = self.take_images()
+            self.pre_buffer.add(t, images, meta)
+
+        if self.start_phase == 'settling':
+            self.frame_counter.update()
+            settled = not self.frame_counter.get_short(self.native_settle_frames)
+            if not settled and t - self.t_phase < self.native_settle_timeout:
+                return
+
+            self.frame_counter = None
+            self.sizes = self.get_native_sizes()
+            self.start_backends = None
+            self.start_phase = 'opening'
+
+        # The first backend to be tried, in the order of the probe at the largest stream
+        if self.start_backends is None:
+            size = max(self.sizes.values(), key=lambda s: s[0] * s[1])
+            self.start_backends = self.select_backends(size)
+            self.start_next_backend()
+            return
+
+        status = [w.get_open_status() for w in self.writers.values()]
+
+        if all(s == 1 for s in status):
+            self.finish_start()
+            return
+
+        if all(s >= 0 for s in status) and time.time() - self.t_phase < self.open_timeout:
+            return
+
+        # Fall back to the next backend if one cannot be opened after all
+        print 'Video encoder {} could not be opened.'.format(self.backend.get_name())
+        self.close_encoders()
+        shutil.rmtree(self.session_dir)
+        self.session_dir = None
+        self.start_next_backend()
+
+    def start_next_backend(self):
+        '''
+        Start the encoders with the next backend to be tried, or give up if none is left.
+        '''
+        if not self.start_backends:
             print 'Video writer could not be opened.'
-            return False
+            self.mediator.emit_signal( signal_name = 'set_info_text',
+                                       arg = {'line': 9, 'text': 'Video writer could not be opened.'} )
+            self.start_phase = None
+            self.close_writers()
+            # Pause without waiting for the gui
+            self.pausing = True
+            return
+
+        if self.record_mode == 'native':
+            n_slots = self.native_queue_slots
+        else:
+            n_slots = self.queue_slots
+
+        self.backend = self.start_backends.pop(0)
+        self.session_dir = self.make_session_dir()
+        self.start_encoders(self.backend, n_slots)
+        self.t_phase = time.time()
+
+    def finish_start(self):
+        '''
+        All the video files are opened, so the recording starts.
+        '''
+        self.start_phase = None
+
+        if self.record_mode == 'native':
+            self.meta_file = open(os.path.join(self.session_dir, 'meta.jsonl'), 'w')
+
+        self.n_written = 0
+
+        # The recording starts with the buffered images
+        seconds = self.pre_buffer.get_seconds()
+        if not self.pre_buffer.is_empty():
+            self.pre_buffer.set_draining(True)
 
         # Change the icon of the gui button
         self.mediator.emit_signal('recording_starts')
 
-        self.recording_start_time = time.clock()
+        self.recording_start_time = time.clock() - seconds
+
+    def cancel_start(self):
+        '''
+        Stopped before the video files were opened, so nothing has been recorded.
+        '''
+        self.start_phase = None
+        self.frame_counter = None
+
+        self.close_writers()
+
+        if not self.session_dir is None:
+            shutil.rmtree(self.session_dir, ignore_errors=True)
+            self.session_dir = None
+
+    def start_encoders(self, backend, n_slots):
+        '''
+        Start one encoder process for each stream, without waiting for the video files to be opened.
+        '''
+        for name in self.sizes.keys():
+            self.writers[name] = EncoderProcess(directory = self.session_dir        ,
+                                                   stream = name                    ,
+                                                  backend = backend                 ,
+                                                      fps = self.fps                ,
+                                                     size = self.sizes[name]        ,
+                                          segment_seconds = self.segment_seconds    ,
+                                                  n_slots = n_slots                 ,
+                                                   policy = self.queue_policy       ,
+                                            write_timeout = self.write_timeout      )
+
+    def close_encoders(self):
+        '''
+        Wait for the remaining frames to be encoded, and close the video files.
+        '''
+        for writer in self.writers.values():
+            writer.close(self.close_timeout)
+        self.writers = {}
+
+    def close_writers(self):
+        '''
+        Close the video files and the metadata file,
+            and let the cameras go back to the size required by the display.
+        '''
+        self.close_encoders()
+
+        for img in self.imgs_resized.values():
+            buffer_pool.release(img)
+        self.imgs_resized = {}
+
+        if not self.meta_file is None:
+            self.meta_file.close()
+            self.meta_file = None
+
+        if self.record_mode == 'native':
+            self.process_thread.set_full_source(False)
+
+    def abort_recording(self):
+        '''
+        Called by this thread when an encoder process has exited, e.g. failing to open a segment.
+        End the recording, keeping what has been written, and pause without waiting for the gui.
+        '''
+        print 'Video encoder exited, recording ended.'
+
+        self.pre_buffer.clear()
+        self.pre_buffer.set_draining(False)
+
+        self.close_writers()
+
+        self.mediator.emit_signal('recording_ends', arg=self.session_dir)
+        self.mediator.emit_signal('set_time_label', '')
+        self.session_dir = None
 
-        return True
+        self.pausing = True
 
     def after_paused(self):
 
-        self.writer.release()
-        self.writer = None
+        # Stopped while starting
+        if not self.start_phase is None:
+            self.cancel_start()
+            return True
+
+        # Already ended by self.abort_recording(), or never started
+        if self.session_dir is None:
+            return True
+
+        # Write the images still waiting in the buffer, as long as the encoders make progress
+        t_progress = time.time()
+        while self.pre_buffer.is_draining():
+            n = self.pre_buffer.get_count()
+            self.drain(t_limit = time.time() + 0.1)
+            if self.pre_buffer.get_count() < n:
+                t_progress = time.time()
+
+            alive = all(w.is_alive() for w in self.writers.values())
+            if not alive or time.time() - t_progress > self.close_timeout:
+                print 'Video encoder not making progress, {} buffered frames discarded'.format(self.pre_buffer.get_count())
+                self.pre_buffer.clear()
+                self.pre_buffer.set_draining(False)
+                break
+
+            time.sleep(0.01)
 
-        # Signal gui to change the icon of the button...
-        #     and let the user to rename the temp file
-        self.mediator.emit_signal('recording_ends', arg=self.temp_video_fname)
+        self.close_writers()
+
+        # Signal gui to change the icon of the button
+        self.mediator.emit_signal('recording_ends', arg=self.session_dir)
         self.mediator.emit_signal('set_time_label', '')
+        self.session_dir = None
         return True
 
     def after_stopped(self):
 
-        if not self.isPaused:
-            self.writer.release()
-            os.remove(self.temp_video_fname)
+        if not self.start_phase is None:
+            self.cancel_start()
+
+        # Keep what has been recorded so far
+        elif self.writers:
+            self.close_writers()
 
         return True
 
-    def set_process_thread(self, thread):
-        self.process_thread = thread
+    def set_record_mode(self, mode):
+        '''
+        Args:
+            mode: str, 'display' or 'native'
+
+        Returns:
+            False if recording is in progress or starting, True otherwise
+        '''
+        if self.writers or not self.start_phase is None:
+            return False
+
+        # The buffered images are of the other streams
+        if mode != self.record_mode:
+            self.pre_buffer.clear()
 
+        self.record_mode = mode
 
+        # Probe for the sensor resolution before the recording starts
+        if mode == 'native':
+            self.probe_in_background(self.get_native_size())
+
+        return True
+
+    def get_record_mode(self):
+        return self.record_mode
+
+    def set_process_thread(self, thread):
+        self.process_thread = thread
@@ -0,0 +1,198 @@
+import numpy as np
+import cv2, time, sys, os, subprocess, tempfile, shutil
+from single_camera import fourcc
+
+
+
+class PipeWriter(object):
+    '''
+    Feeds raw BGR frames to an external encoder, e.g. ffmpeg, through its stdin.
+    Has the same interface as cv2.VideoWriter.
+    '''
+
+    def __init__(self, command, filename, fps, size):
+        super(PipeWriter, self).__init__()
+
+        width, height = size
+        args = [a.format(filename=filename, fps=fps, width=width, height=height) for a in command]
+
+        self.size = size
+
+        try:
+            with open(os.devnull, 'w') as devnull:
+                self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
+        except OSError:
+            # The encoder is not installed
+            self.proc = None
+
+    def isOpened(self):
+        return not self.proc is None and self.proc.poll() is None
+
+    def write(self, img):
+        if not self.isOpened():
+            return
+
+        try:
+            self.proc.stdin.write(img.tostring())
+        except IOError:
+            # The encoder has exited
+            self.release()
+
+    def release(self):
+        if self.proc is None:
+            return
+
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+
+
+class EncoderBackend(object):
+    '''
+    A way of encoding video files, described by one entry of "backends" in parameters/video_writer.json:
+        'opencv' --- cv2.VideoWriter with a fourcc, e.g. 'X264', 'MJPG', or 'FFV1' (lossless)
+        'pipe'   --- an external encoder fed raw frames through a pipe, see PipeWriter
+
+    The object is passed to the encoder process, so it only holds plain values.
+    '''
+
+    def __init__(self, spec):
+        '''
+        Args:
+            spec: dictionary with the keys
+                'name': str
+                'type': str, 'opencv' or 'pipe'
+                'ext': str, the file extension, e.g. '.avi'
+                'fourcc': str, for the 'opencv' type
+                'command': list of str, for the 'pipe' type,
+                    in which {filename}, {fps}, {width} and {height} are replaced
+        '''
+        super(EncoderBackend, self).__init__()
+
+        self.name = spec['name']
+        self.type = spec['type']
+        self.ext = spec['ext']
+        self.fourcc = spec.get('fourcc', None)
+        self.command = spec.get('command', None)
+
+    def open(self, filename, fps, size):
+        '''
+        Args:
+            filename: str, without the extension
+            fps: float
+            size: tuple (width, height)
+
+        Returns:
+            an opened writer object with the write() and release() methods, or None if it cannot be opened
+        '''
+        filename = filename + self.ext
+
+        if self.type == 'opencv':
+            writer = cv2.VideoWriter(filename, fourcc(self.fourcc), fps, size)
+        elif self.type == 'pipe':
+            writer = PipeWriter(self.command, filename, fps, size)
+        else:
+            print 'Unknown encoder backend type {}'.format(self.type)
+            return None
+
+        if not writer.isOpened():
+            return None
+
+        return writer
+
+    def get_name(self):
+        return self.name
+
+    def get_ext(self):
+        return self.ext
+
+
+
+def load_backends(specs):
+    '''
+    Returns:
+        a list of EncoderBackend objects, in the order of preference of the specs
+    '''
+    return [EncoderBackend(spec) for spec in specs]
+
+
+
+def make_probe_frames(size, n_frames):
+    '''
+    Returns:
+        a list of images with some texture and motion, which compress roughly like camera images.
+        They are views shifting across one wider image, so only that one image is allocated.
+    '''
+    width, height = size
+    step = 4
+
+    base = np.empty((height, width + step * n_frames, 3), np.uint8)
+    cv2.randu(base, 0, 256)
+    cv2.GaussianBlur(base, (0, 0), 5, dst=base)
+    cv2.normalize(base, base, 0, 255, cv2.NORM_MINMAX)
+
+    return [base[:, (step * i):(step * i + width)] for i in range(n_frames)]
+
+
+
+def probe_backend(backend, fps, size, n_frames):
+    '''
+    Measure how many frames per second the backend sustains at the size, including finalizing the file.
+
+    Returns:
+        float, the frame rate, or 0 if the backend is not available
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        writer = backend.open(os.path.join(directory, 'probe'), fps, size)
+        if writer is None:
+            return 0.
+
+        frames = make_probe_frames(size, n_frames)
+
+        t0 = time.time()
+        for img in frames:
+            writer.write(img)
+        writer.release()
+        dt = time.time() - t0
+
+        # Nothing written, e.g. an encoder which exited right after starting
+        fname = os.path.join(directory, 'probe' + backend.get_ext())
+        if not os.path.exists(fname) or os.path.getsize(fname) == 0:
+            return 0.
+
+        return n_frames / max(dt, 1e-6)
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+
+def rank_backends(backends, fps, size, n_frames, margin):
+    '''
+    Probe the backends, and rank the ones which are available.
+
+    The backends sustaining fps * margin come first, in the order of preference.
+    The slower ones follow, the faster first.
+
+    Returns:
+        a list of tuples (EncoderBackend, measured fps)
+    '''
+    fast, slow = [], []
+
+    for backend in backends:
+        rate = probe_backend(backend, fps, size, n_frames)
+        if rate == 0:
+            continue
+        if rate >= fps * margin:
+            fast.append((backend, rate))
+        else:
+            slow.append((backend, rate))
+
+    slow.sort(key=lambda x: x[1], reverse=True)
+
+    return fast + slow
@@ -0,0 +1,396 @@
+import numpy as np
+import cv2, time, sys, os, json, multiprocessing
+from shared_frames import SharedFrameQueue
+
+
+
+def append_index(fname, entry):
+    '''
+    Append one line of JSON to the index file, and make sure it is on the disk.
+    '''
+    with open(fname, 'a') as fh:
+        fh.write(json.dumps(entry) + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+
+def read_index(fname):
+    '''
+    Returns:
+        a dictionary {segment number: the last index entry of the segment}
+    '''
+    segments = {}
+    with open(fname, 'r') as fh:
+        for line in fh:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line is incomplete after a crash
+                continue
+            segments[entry['segment']] = entry
+    return segments
+
+
+
+class SegmentedVideoWriter(object):
+    '''
+    Writes a video stream as a series of segment files of a fixed number of frames,
+        e.g. R_0000.avi, R_0001.avi... in the recording directory, with an EncoderBackend.
+
+    Each segment is finalized as soon as it is full, so a crash loses at most the open segment,
+        and even that one can be recovered by recover_recordings().
+    The segments are listed in an index file, e.g. R_index.jsonl, one line when a segment is opened,
+        and one more line when it is closed, with its time span and number of frames.
+    '''
+
+    def __init__(self, directory, stream, backend, fps, size, segment_frames):
+        super(SegmentedVideoWriter, self).__init__()
+
+        self.directory = directory
+        self.stream = stream
+        self.backend = backend
+        self.fps = fps
+        self.size = size
+        self.segment_frames = segment_frames
+
+        self.index_fname = os.path.join(directory, '{}_index.jsonl'.format(stream))
+
+        self.segment = -1
+        self.writer = None
+
+    def open_segment(self):
+        '''
+        Returns:
+            True if the next segment file is opened, False otherwise
+        '''
+        self.segment += 1
+        name = '{}_{:04d}'.format(self.stream, self.segment)
+        self.fname = name + self.backend.get_ext()
+
+        self.writer = self.backend.open(os.path.join(self.directory, name), self.fps, self.size)
+
+        if self.writer is None:
+            return False
+
+        self.n_frames = 0
+        self.t_start = None
+        self.t_end = None
+
+        append_index(self.index_fname, {'segment': self.segment          ,
+                                        'file'   : self.fname            ,
+                                        'backend': self.backend.get_name(),
+                                        'status' : 'open'                })
+        return True
+
+    def close_segment(self):
+
+        self.writer.release()
+        self.writer = None
+
+        append_index(self.index_fname, {'segment': self.segment ,
+                                        'file'   : self.fname   ,
+                                        'status' : 'closed'     ,
+                                        'start'  : self.t_start ,
+                                        'end'    : self.t_end   ,
+                                        'frames' : self.n_frames})
+
+    def write(self, img, timestamp):
+        '''
+        Returns:
+            False if the next segment could not be opened, True otherwise
+        '''
+        if self.writer is None:
+            if not self.open_segment():
+                return False
+
+        self.writer.write(img)
+
+        if self.t_start is None:
+            self.t_start = timestamp
+        self.t_end = timestamp
+        self.n_frames += 1
+
+        if self.n_frames >= self.segment_frames:
+            self.close_segment()
+
+        return True
+
+    def release(self):
+        if not self.writer is None:
+            self.close_segment()
+
+
+
+def run_encoder_process(queue, directory, stream, backend, fps, size, segment_frames, opened, encoded, duplicated):
+    '''
+    The main function of the encoder process.
+
+    Encodes the frames from the queue at a constant frame rate until the queue is closed and drained.
+    The previous frame is repeated to fill in the gaps of the timestamps, so the video keeps real time,
+        and no content is shown before its time.
+    '''
+    writer = SegmentedVideoWriter(directory, stream, backend, fps, size, segment_frames)
+
+    if not writer.open_segment():
+        opened.value = -1
+        return
+
+    opened.value = 1
+
+    t_last = None # Timestamp of the last frame encoded
+    img_last = None
+    while True:
+        img, timestamp = queue.get(timeout=0.1)
+
+        if img is None:
+            if queue.is_closed() and queue.is_empty():
+                break
+            continue
+
+        # The number of frame periods since the last frame, of which all but one are filled by duplicates
+        if not t_last is None:
+            n = int(round((timestamp - t_last) * fps))
+            for i in range(n - 1):
+                writer.write(img_last, t_last + (i + 1) / float(fps))
+                duplicated.value += 1
+        t_last = timestamp
+        img_last = img
+
+        if not writer.write(img, timestamp):
+            print 'Segment {} of stream {} could not be opened.'.format(writer.segment, stream)
+            break
+
+        encoded.value += 1
+
+    writer.release()
+
+
+
+def recover_segment(directory, entry, backends, fps):
+    '''
+    Re-encode the readable frames of a segment left open by a crash, so the file is finalized.
+    The first of the backends which can be opened is used.
+
+    The original file is only replaced by a complete recovered file.
+    If it cannot be read or re-encoded, it is kept as it is and marked 'unrecoverable',
+        e.g. for a container which this OpenCV build cannot read, but other players can.
+
+    Returns:
+        the closing index entry of the segment
+    '''
+    fname = os.path.join(directory, entry['file'])
+    name = os.path.splitext(entry['file'])[0]
+    temp_name = os.path.join(directory, name + '_recovering')
+
+    entry = {'segment': entry['segment'],
+             'file'   : entry['file']   ,
+             'status' : 'lost'          ,
+             'frames' : 0               }
+
+    if not os.path.exists(fname):
+        return entry
+
+    cap = cv2.VideoCapture(fname)
+    writer = None
+    temp_fname = None
+
+    while True:
+        ret, img = cap.read()
+        if not ret:
+            break
+
+        if writer is None:
+            h, w, _ = img.shape
+            for backend in backends:
+                writer = backend.open(temp_name, fps, (w, h))
+                if not writer is None:
+                    temp_fname = temp_name + backend.get_ext()
+                    break
+            if writer is None:
+                break
+
+        writer.write(img)
+        entry['frames'] += 1
+
+    cap.release()
+
+    if writer is None:
+        entry['status'] = 'unrecoverable'
+        return entry
+
+    writer.release()
+
+    if not os.path.exists(temp_fname) or os.path.getsize(temp_fname) == 0:
+        if os.path.exists(temp_fname):
+            os.remove(temp_fname)
+        entry['status'] = 'unrecoverable'
+        entry['frames'] = 0
+        return entry
+
+    # Replace within the same directory, i.e. without copying.
+    # The extension changes along with the backend.
+    os.remove(fname)
+    entry['file'] = name + backend.get_ext()
+    entry['backend'] = backend.get_name()
+    os.rename(temp_fname, os.path.join(directory, entry['file']))
+
+    entry['status'] = 'recovered'
+    return entry
+
+
+
+def list_recordings(directory):
+    '''
+    Returns:
+        a list of the recording directories in the directory
+    '''
+    if not os.path.isdir(directory):
+        return []
+
+    paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+
+    return [p for p in paths if os.path.isdir(p)]
+
+
+
+def recover_recordings(session_dirs, backends, fps):
+    '''
+    Find the segments left open in the recordings, e.g. after a crash or a power loss,
+        recover them and close them in their index files.
+
+    Args:
+        session_dirs: list of recording directories, which must not include a recording in progress
+    '''
+    for session_dir in session_dirs:
+
+        for fname in sorted(os.listdir(session_dir)):
+            if not fname.endswith('_index.jsonl'):
+                continue
+
+            index_fname = os.path.join(session_dir, fname)
+            segments = read_index(index_fname)
+
+            for segment in sorted(segments.keys()):
+                entry = segments[segment]
+                if entry['status'] == 'open':
+                    entry = recover_segment(session_dir, entry, backends, fps)
+                    append_index(index_fname, entry)
+                    print 'Recording {}, {} {} with {} frames'.format(session_dir, entry['file'],
+                                                                     entry['status'], entry['frames'])
+
+
+
+class EncoderProcess(object):
+    '''
+    Encodes video in a separate process, so encoding does not compete for the GIL
+        with capturing, processing and displaying.
+
+    Frames are passed with timestamps through a SharedFrameQueue, i.e. copied once into shared memory,
+        and written as segment files by a SegmentedVideoWriter.
+    '''
+
+    def __init__(self, directory, stream, backend, fps, size, segment_seconds, n_slots, policy, write_timeout):
+        '''
+        Args:
+            directory: str, the recording directory
+            stream: str, the name of the stream, which prefixes the segment and index files
+            backend: EncoderBackend
+            fps: float, frame rate of the video
+            size: tuple (width, height) of the video
+            segment_seconds: float, the duration of each segment file
+            n_slots: int, maximum number of frames waiting to be encoded
+            policy: str, 'drop_oldest' or 'block', what to do when the queue is full
+            write_timeout: float, the maximum seconds to wait for a free slot under the 'block' policy
+        '''
+        super(EncoderProcess, self).__init__()
+
+        self.write_timeout = write_timeout
+
+        width, height = size
+        self.queue = SharedFrameQueue(n_slots   = n_slots           ,
+                                      max_bytes = width * height * 3,
+                                      policy    = policy            )
+
+        self.opened = multiprocessing.RawValue('i', 0) # 1 if opened, -1 if failed
+        self.encoded = multiprocessing.RawValue('l', 0)
+        self.duplicated = multiprocessing.RawValue('l', 0)
+
+        self.process = multiprocessing.Process(target = run_encoder_process,
+                                               args = (self.queue     ,
+                                                       directory      ,
+                                                       stream         ,
+                                                       backend        ,
+                                                       fps            ,
+                                                       size           ,
+                                                       int(segment_seconds * fps),
+                                                       self.opened    ,
+                                                       self.encoded   ,
+                                                       self.duplicated))
+        self.process.daemon = True
+        self.process.start()
+
+    def get_open_status(self):
+        '''
+        Never blocks.
+
+        Returns:
+            1 if the video file is opened for encoding, -1 if it could not be opened, 0 if still opening
+        '''
+        if self.opened.value == 0 and not self.process.is_alive():
+            return -1
+        return self.opened.value
+
+    def wait_until_opened(self, timeout):
+        '''
+        Returns:
+            True if the video file is opened for encoding, False otherwise
+        '''
+        t0 = time.time()
+        while self.opened.value == 0 and self.process.is_alive():
+            if time.time() - t0 > timeout:
+                break
+            time.sleep(0.01)
+
+        return self.opened.value == 1
+
+    def write(self, img, timestamp):
+        '''
+        Never blocks for longer than self.write_timeout, nor at all once the encoder process has exited.
+
+        Returns:
+            False if the frame could not be queued, True otherwise
+        '''
+        return self.queue.put(img, timestamp, timeout=self.write_timeout, is_alive=self.process.is_alive)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def get_free_slots(self):
+        '''
+        Returns:
+            the number of frames which can be written without dropping or waiting
+        '''
+        return self.queue.get_free_slots()
+
+    def get_counters(self):
+        '''
+        Returns:
+            a dictionary of the number of frames 'encoded', 'dropped' and 'duplicated'
+        '''
+        return {'encoded'   : self.encoded.value        ,
+                'dropped'   : self.queue.get_dropped()  ,
+                'duplicated': self.duplicated.value     }
+
+    def close(self, timeout):
+        '''
+        Encode the remaining frames and close the video file.
+        A stuck encoder is terminated after timeout seconds, leaving its segment open for recovery.
+        '''
+        self.queue.close()
+
+        self.process.join(timeout)
+        if self.process.is_alive():
+            print 'Encoder process not responding, terminated'
+            self.process.terminate()
+            self.process.join()
@@ -109,6 +109,7 @@ class WinduGUI(QtGui.QMainWindow):
              ('start_select_cam'     , 'Select Cameras'                ,    False      ,      True       ),
              ('open_camera_tuner'    , 'Adjust Camera Parameters'      ,    False      ,      False      ),
              ('toggle_auto_cam'      , 'Camera Auto Mode'              ,    False      ,      True       ),
+             ('equalize_cameras'     , 'Match Colors (Ctrl+E)'         ,    False      ,      True       ),
              ('toggle_fullscreen'    , 'Show Fullscreen (Ctrl+F)'      ,    False      ,      False      ),
              ('toggle_view_mode'     , 'Switch View Mode (Ctrl+V)'     ,    False      ,      True       )]
 
@@ -166,7 +167,9 @@ class WinduGUI(QtGui.QMainWindow):
         K = [('toggle_recording'   , 'Ctrl+R'        ),
              ('toggle_auto_offset' , 'Ctrl+A'        ),
              ('toggle_view_mode'   , 'Ctrl+V'        ),
-             ('toggle_view_mode'   , 'b'             )]
+             ('equalize_cameras'   , 'Ctrl+E'        ),
+             ('toggle_native_recording', 'Shift+Ctrl+R'),
+             ('toggle_recording'   , self.pedal_key  )]
 
         for method_name, key_comb in K:
             method = self.controller.get_method(method_name)
@@ -351,7 +354,7 @@ class WinduGUI(QtGui.QMainWindow):
         for l in [self.time_label_L, self.time_label_R]:
             l.show()
 
-    def recording_ends(self, temp_filename):
+    def recording_ends(self, session_dir):
         self.recording_animator.stop()
         self.actions['toggle_recording'].setIcon(QtGui.QIcon('icons/toggle_recording.png'))
         self.actions['toggle_recording'].setText('Record Video')
@@ -359,25 +362,8 @@ class WinduGUI(QtGui.QMainWindow):
         for l in [self.time_label_L, self.time_label_R]:
             l.hide()
 
-        i = 1
-        while os.path.exists('stereo_video_%03d.avi' % i):
-            i += 1
-
-        fname = QtGui.QFileDialog.getSaveFileName(parent    = self,
-                                                  directory = 'stereo_video_%03d.avi' % i,
-                                                  caption   = 'Save stereo video',
-                                                  filter    = 'Audio Video Interleaved (*.avi)')
-
-        if fname != '':
-            fname = str(fname)
-            if not fname.endswith('.avi'):
-                fname = fname + '.avi'
-            if os.path.exists(fname):
-                os.remove(fname)
-            os.rename(temp_filename, fname)
-
-        else:
-            os.remove(temp_filename)
+        # The recording is already in its directory, so there is nothing to rename or copy
+        QtGui.QMessageBox.information(self, 'Stereo video', 'Recorded in {}'.format(os.path.abspath(session_dir)))
 
     def auto_offset_resumed(self):
         self.actions['toggle_auto_offset'].setIcon(QtGui.QIcon('icons/pause_auto_offset.png'))
@@ -415,6 +401,12 @@ class WinduGUI(QtGui.QMainWindow):
     def set_info_text(self, data):
         self.info_window.setText(data['line'], data['text'])
 
+    def set_quality_level(self, data):
+        if data['level'] == 0:
+            self.setWindowTitle('Windu Vision')
+        else:
+            self.setWindowTitle('Windu Vision - Reduced quality: {}'.format(data['text']))
+
     def display_topography(self, vertices):
         self.gl_window.gl_widget.updateObject(vertices)
 
@@ -457,7 +449,7 @@ class WinduGUI(QtGui.QMainWindow):
         widget.close()
 
         if not which_cam is None:
-            data = {'id': id, 'which_cam': which_cam}
+            data = {'id': id, 'device': data['device'], 'which_cam': which_cam}
             self.controller.call_method( method_name = 'save_cam_id', arg = data )
 
         self.controller.call_method( method_name = 'next_cam')
@@ -484,6 +476,14 @@ class WinduGUI(QtGui.QMainWindow):
     def select_cam_done(self):
         self.controller.call_method(method_name = 'start_video_thread')
 
+    def calibration_done(self, failed):
+        self.camera_tuner_window_set.load_response_tables()
+        self.controller.call_method(method_name = 'end_calibration')
+
+        if failed:
+            QtGui.QMessageBox.warning(self, 'Calibrate Response',
+                                      'Calibration failed for camera {}, the previous tables are kept.'.format(', '.join(failed)))
+
     def update_cam_parm(self, data):
         which_cam = data['which_cam']
         name = data['name']